@@ -1,34 +1,52 @@
 import os
-import shutil
+import uuid
+import asyncio
+import time
+from pathlib import PurePosixPath
 from datetime import datetime, timezone, timedelta
 from contextlib import asynccontextmanager
+from typing import List, Optional
 
 import uvicorn
 from apscheduler.schedulers.background import BackgroundScheduler
 from dotenv import load_dotenv
 from fastapi import FastAPI, File, Form, UploadFile, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
+from pydantic import BaseModel, ConfigDict, field_validator
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import load_only
 import logging
 
-from helper import upload_to_gdrive, get_gdrive_service
+from helper import upload_to_gdrive, get_gdrive_service, close_smtp_connection
 from db import (
     Task,
     StorageType,
     TaskStatus,
     get_db,
-    prepare_gdrive_download_task,
-    print_file_task,
+    init_db,
+    async_engine,
+    download_executor,
+    print_executor,
+    poll_due_tasks,
+    remove_orphaned_uploads,
+    recover_interrupted_tasks,
 )
 
 load_dotenv()
 
 MAX_FILE_SIZE_MB = 5
 MAX_FILE_SIZE_BYTES = MAX_FILE_SIZE_MB * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024 # Bytes read from the upload per write to disk
 PRINTER_NAME = os.getenv("PRINTER_NAME")
 LOCAL_STORAGE_PATH = "uploads"
 GDRIVE_DOWNLOAD_SUBDIR = "gdrive_downloads"
 GDRIVE_DOWNLOAD_FULL_PATH = os.path.join(LOCAL_STORAGE_PATH, GDRIVE_DOWNLOAD_SUBDIR)
+GDRIVE_UNAVAILABLE_DETAIL = "File is large, but Google Drive is not configured/available for upload."
+# Comma-separated list of origins allowed to call the API (the React dev server by default)
+FRONTEND_ORIGINS = [origin.strip() for origin in os.getenv("FRONTEND_ORIGIN", "http://localhost:3000").split(",") if origin.strip()]
+POLL_INTERVAL_SECONDS = 15 # How often the scheduler checks for due downloads/prints
+GDRIVE_REPROBE_INTERVAL_SECONDS = 60 # While Drive is down, rebuild the client at most this often
 
 os.makedirs(LOCAL_STORAGE_PATH, exist_ok=True)
 os.makedirs(GDRIVE_DOWNLOAD_FULL_PATH, exist_ok=True)
@@ -38,35 +56,102 @@ logger = logging.getLogger(__name__)
 
 scheduler = BackgroundScheduler(timezone="UTC")
 
+def safe_filename(filename: str) -> str:
+    # Drop any directory components the client sent (e.g. "../../etc/passwd")
+    return PurePosixPath(filename.replace("\\", "/")).name
+
+def _gdrive_configured(gdrive_service) -> bool:
+    return gdrive_service is not None and bool(os.getenv("GDRIVE_FOLDER_ID"))
+
+def gdrive_available() -> bool:
+    return _gdrive_configured(get_gdrive_service())
+
+async def gdrive_ready() -> bool:
+    # Drive may have been configured (or come back) since startup. Probing builds the
+    # client and reads credentials, so it runs off the event loop and is rate-limited.
+    if not app.state.gdrive_ok and time.monotonic() - app.state.gdrive_checked_at >= GDRIVE_REPROBE_INTERVAL_SECONDS:
+        app.state.gdrive_checked_at = time.monotonic() # Set before awaiting so concurrent uploads don't probe too
+        app.state.gdrive_ok = await asyncio.to_thread(gdrive_available)
+    return app.state.gdrive_ok
+
 @asynccontextmanager
 async def lifespan(app_instance: FastAPI): # Renamed 'app' parameter to 'app_instance'
+    init_db()
+    recover_interrupted_tasks()
+    remove_orphaned_uploads(LOCAL_STORAGE_PATH)
     scheduler.start()
+    scheduler.add_job(
+        poll_due_tasks, # Imported from db.py
+        'interval',
+        seconds=POLL_INTERVAL_SECONDS,
+        args=[GDRIVE_DOWNLOAD_FULL_PATH, PRINTER_NAME],
+        id="poll_due_tasks",
+        next_run_time=datetime.now(timezone.utc), # Catch up on anything that came due while we were down
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True,
+    )
     logger.info("APScheduler started.")
     gdrive_service = get_gdrive_service()
     if not gdrive_service:
          logger.warning("Google Drive service could not be initialized at startup. Check credentials.json and GDRIVE_FOLDER_ID.")
     elif not os.getenv("GDRIVE_FOLDER_ID"): 
         logger.warning("GDRIVE_FOLDER_ID is not set. Google Drive uploads will fail.")
+    app_instance.state.gdrive_ok = _gdrive_configured(gdrive_service)
+    app_instance.state.gdrive_checked_at = time.monotonic()
     if not PRINTER_NAME:
         logger.warning("PRINTER_NAME is not set. Printing will fail.")
     if not all([os.getenv("SMTP_SERVER"), os.getenv("SMTP_PORT"), os.getenv("SMTP_USERNAME"), os.getenv("SENDER_EMAIL")]):
         logger.warning("SMTP settings are not fully configured in .env. Email notifications may fail.")
     yield
     scheduler.shutdown()
+    # Queued jobs are dropped and their claims released back to SCHEDULED, so they get
+    # picked up on the next start.
+    download_executor.shutdown(wait=False, cancel_futures=True)
+    print_executor.shutdown(wait=False, cancel_futures=True)
+    close_smtp_connection()
     logger.info("APScheduler shut down.")
+    await async_engine.dispose()
 
 # Instantiate the app *once* and use the lifespan context manager
 app = FastAPI(title="IoT Printing Backend", lifespan=lifespan)
+app.state.gdrive_ok = False # Set at startup; re-checked only when a large upload needs Drive
+app.state.gdrive_checked_at = float("-inf")
 
 # Apply CORS Middleware to the correct app instance
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"], 
-    allow_credentials=True,
-    allow_methods=["*"], 
-    allow_headers=["*"], 
+    allow_origins=FRONTEND_ORIGINS,
+    allow_methods=["GET", "POST"],
+    allow_headers=["content-type"],
+    max_age=86400, # Let browsers cache preflight responses for a day
 )
 
+class TaskSummary(BaseModel):
+    # Columns loaded by list_tasks; reading anything else would trigger a lazy load
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    original_filename: str
+    uploader_email: str
+    storage_type: StorageType
+    time_to_print: datetime
+    status: TaskStatus
+    created_at: datetime
+
+    @field_validator("time_to_print", "created_at")
+    @classmethod
+    def assume_utc(cls, value: datetime) -> datetime:
+        # SQLite drops the tzinfo; everything is stored in UTC
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+class TaskOut(TaskSummary):
+    file_identifier: str
+    gdrive_download_path: Optional[str] = None
+    color_mode: str
+    page_size: str
+    error_message: Optional[str] = None
+
 @app.post("/add-task/")
 async def add_task(
     file: UploadFile = File(...),
@@ -74,64 +159,74 @@ async def add_task(
     color_mode: str = Form(...), 
     page_size: str = Form(...), 
     uploader_email: str = Form(...), 
-    db: Session = Depends(get_db) # get_db is now imported from db.py
+    db: AsyncSession = Depends(get_db) # get_db is now imported from db.py
 ):
     if color_mode not in ["color", "bw"]:
         raise HTTPException(status_code=400, detail="Invalid color_mode. Must be 'color' or 'bw'.")
     if not uploader_email: 
         raise HTTPException(status_code=400, detail="uploader_email is required.")
 
-    temp_file_id = f"temp_{datetime.now(timezone.utc).timestamp()}_{file.filename}"
-    temp_file_path = os.path.join(LOCAL_STORAGE_PATH, temp_file_id)
+    # All form validation happens before the upload is written anywhere
     try:
-        with open(temp_file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-    finally:
-        file.file.close()
+        print_datetime = datetime.fromtimestamp(time_to_print_ts, tz=timezone.utc)
+    except (ValueError, OverflowError, OSError):
+        raise HTTPException(status_code=400, detail="Invalid time_to_print_ts. Must be a valid Unix timestamp.")
 
-    file_size = os.path.getsize(temp_file_path)
-    
+    if print_datetime <= datetime.now(timezone.utc) + timedelta(minutes=1): 
+        raise HTTPException(status_code=400, detail="time_to_print must be in the future (at least 1 minute ahead).")
+
+    # Starlette records the size while parsing the form, so an upload we can't
+    # store is refused before we copy any of it.
+    if file.size is not None and file.size > MAX_FILE_SIZE_BYTES and not await gdrive_ready():
+        raise HTTPException(status_code=413, detail=GDRIVE_UNAVAILABLE_DETAIL)
+
+    filename = safe_filename(file.filename)
+    upload_id = uuid.uuid4().hex # Unique per request, unlike a timestamp
     storage_type_val: StorageType # Imported from db.py
     file_identifier_val: str
+    temp_file_path = None
 
-    gdrive_service_available = get_gdrive_service() is not None and os.getenv("GDRIVE_FOLDER_ID") is not None
+    try:
+        # Reading one byte past the limit tells us which branch we're in without a temp file
+        head = await file.read(MAX_FILE_SIZE_BYTES + 1)
+        if len(head) <= MAX_FILE_SIZE_BYTES:
+            final_local_path = os.path.join(LOCAL_STORAGE_PATH, f"local_{upload_id}_{filename}")
+            with open(final_local_path, "wb") as buffer:
+                buffer.write(head)
+            storage_type_val = StorageType.LOCAL
+            file_identifier_val = final_local_path
+            logger.info(f"File {filename} stored locally at {final_local_path}.")
+        else:
+            if not await gdrive_ready():
+                raise HTTPException(status_code=413, detail=GDRIVE_UNAVAILABLE_DETAIL)
+            # Spill to disk once so MediaFileUpload can stream it to Drive
+            temp_file_path = os.path.join(LOCAL_STORAGE_PATH, f"temp_{upload_id}_{filename}")
+            with open(temp_file_path, "wb") as buffer:
+                buffer.write(head)
+                del head
+                while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                    buffer.write(chunk)
+    finally:
+        await file.close()
 
-    if file_size > MAX_FILE_SIZE_BYTES:
-        if not gdrive_service_available:
-            os.remove(temp_file_path) 
-            raise HTTPException(status_code=500, detail="File is large, but Google Drive is not configured/available for upload.")
-        logger.info(f"File {file.filename} is larger than {MAX_FILE_SIZE_MB}MB. Uploading to Google Drive.")
+    if temp_file_path:
+        logger.info(f"File {filename} is larger than {MAX_FILE_SIZE_MB}MB. Uploading to Google Drive.")
         try:
-            gdrive_file_id = upload_to_gdrive(temp_file_path, file.filename) 
+            # Blocking network I/O; keep it off the event loop
+            gdrive_file_id = await asyncio.to_thread(upload_to_gdrive, temp_file_path, filename)
             storage_type_val = StorageType.GDRIVE
             file_identifier_val = gdrive_file_id
             os.remove(temp_file_path) 
             logger.info(f"Removed local temp file {temp_file_path} after GDrive upload.")
         except (ConnectionError, ValueError, Exception) as e: 
+            if isinstance(e, (ConnectionError, ValueError)):
+                app.state.gdrive_ok = False # Service or folder went missing; re-probe next time
             os.remove(temp_file_path) 
-            logger.error(f"Failed to upload {file.filename} to GDrive: {e}")
+            logger.error(f"Failed to upload {filename} to GDrive: {e}")
             raise HTTPException(status_code=500, detail=f"Google Drive upload failed: {str(e)}")
-    else:
-        final_local_path = os.path.join(LOCAL_STORAGE_PATH, f"local_{datetime.now(timezone.utc).timestamp()}_{file.filename}")
-        shutil.move(temp_file_path, final_local_path)
-        storage_type_val = StorageType.LOCAL
-        file_identifier_val = final_local_path
-        logger.info(f"File {file.filename} stored locally at {final_local_path}.")
-
-    try:
-        print_datetime = datetime.fromtimestamp(time_to_print_ts, tz=timezone.utc)
-    except ValueError:
-        if storage_type_val == StorageType.LOCAL and os.path.exists(file_identifier_val):
-            os.remove(file_identifier_val)
-        raise HTTPException(status_code=400, detail="Invalid time_to_print_ts. Must be a valid Unix timestamp.")
-
-    if print_datetime <= datetime.now(timezone.utc) + timedelta(minutes=1): 
-        if storage_type_val == StorageType.LOCAL and os.path.exists(file_identifier_val):
-            os.remove(file_identifier_val)
-        raise HTTPException(status_code=400, detail="time_to_print must be in the future (at least 1 minute ahead).")
 
     new_task = Task( # Task model imported from db.py
-        original_filename=file.filename,
+        original_filename=filename,
         uploader_email=uploader_email, 
         storage_type=storage_type_val,
         file_identifier=file_identifier_val,
@@ -141,60 +236,52 @@ async def add_task(
         status=TaskStatus.SCHEDULED # TaskStatus imported from db.py
     )
     db.add(new_task)
-    db.commit()
-    db.refresh(new_task)
-
-    print_job_id = f"print_task_{new_task.id}"
-    
-    if new_task.storage_type == StorageType.GDRIVE:
-        download_time = print_datetime - timedelta(minutes=10)
-        if download_time <= datetime.now(timezone.utc):
-            logger.warning(f"Task {new_task.id}: Calculated GDrive download time {download_time.isoformat()} is in the past/present. Scheduling download immediately.")
-            download_time = datetime.now(timezone.utc) + timedelta(seconds=5) 
-        
-        scheduler.add_job(
-            prepare_gdrive_download_task, # Imported from db.py
-            'date',
-            run_date=download_time,
-            args=[new_task.id, scheduler, GDRIVE_DOWNLOAD_FULL_PATH], # Pass scheduler and path
-            id=f"download_task_{new_task.id}",
-            replace_existing=True
-        )
-        logger.info(f"Task {new_task.id} (GDrive): Download scheduled for {download_time.isoformat()}.")
+    try:
+        await db.commit()
+    except Exception:
+        # Don't leave a stored file behind without a task pointing at it
+        if storage_type_val == StorageType.LOCAL and os.path.exists(file_identifier_val):
+            os.remove(file_identifier_val)
+        raise
+    await db.refresh(new_task)
 
-    scheduler.add_job(
-        print_file_task, # Imported from db.py
-        'date',
-        run_date=print_datetime,
-        args=[new_task.id, PRINTER_NAME], # Pass printer_name
-        id=print_job_id, 
-        replace_existing=True
-    )
-    logger.info(f"Task {new_task.id} for {file.filename} (print) scheduled for {print_datetime.isoformat()}")
+    # Nothing to schedule here: poll_due_tasks picks the task up from the table.
+    logger.info(f"Task {new_task.id} for {filename} ({new_task.storage_type.value}) scheduled for {print_datetime.isoformat()}")
 
     return {
         "message": "Task added successfully",
         "task_id": new_task.id,
-        "filename": file.filename,
+        "filename": filename,
         "uploader_email": new_task.uploader_email,
         "storage": new_task.storage_type.value, # .value for Enum
         "print_time": new_task.time_to_print.isoformat(),
         "status": new_task.status.value # .value for Enum
     }
 
-@app.get("/tasks/{task_id}")
-async def get_task_status(task_id: int, db: Session = Depends(get_db)): # get_db from db.py
+@app.get("/tasks/{task_id}", response_model=TaskOut)
+async def get_task_status(task_id: int, db: AsyncSession = Depends(get_db)): # get_db from db.py
     # Task model is imported from db.py
-    task = db.query(Task).filter(Task.id == task_id).first()
+    task = await db.get(Task, task_id) # Primary-key lookup, no query construction
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
     return task
 
-@app.get("/tasks/")
-async def list_tasks(skip: int = 0, limit: int = 10, db: Session = Depends(get_db)): # get_db from db.py
+@app.get("/tasks/", response_model=List[TaskSummary])
+async def list_tasks(skip: int = 0, limit: int = 10, db: AsyncSession = Depends(get_db)): # get_db from db.py
     # Task model is imported from db.py
-    tasks = db.query(Task).order_by(Task.created_at.desc()).offset(skip).limit(limit).all()
-    return tasks
+    # Only the columns the task list needs; full details come from /tasks/{task_id}
+    stmt = (
+        select(Task)
+        .options(load_only(
+            Task.id, Task.original_filename, Task.status, Task.time_to_print,
+            Task.created_at, Task.uploader_email, Task.storage_type,
+        ))
+        .order_by(Task.created_at.desc())
+        .offset(skip)
+        .limit(limit)
+    )
+    result = await db.execute(stmt)
+    return result.scalars().all()
 
 if __name__ == "__main__":
     # GDRIVE_FOLDER_ID is checked by get_gdrive_service in helper.py, PRINTER_NAME is checked at startup
@@ -1,26 +1,70 @@
 import os
 import logging
-import subprocess
-from datetime import datetime, timezone
+import shlex
+from subprocess import run as run_subprocess # Module-level name so tests can patch db.run_subprocess only
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone, timedelta
 import enum 
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Enum as SAEnum
+from typing import Optional
+from sqlalchemy import create_engine, event, select, update, or_, Column, Index, Integer, String, DateTime, Enum as SAEnum
 from sqlalchemy.orm import sessionmaker, declarative_base # Updated import
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.exc import SQLAlchemyError
-from apscheduler.jobstores.base import JobLookupError
+
+try:
+    import cups # pycups: submits jobs to cupsd over IPP without forking lp per print
+except ImportError:
+    cups = None
 
 # Import from helper, but ensure no circular dependencies if helper also imports from db
 from helper import send_email, download_from_gdrive # download_from_gdrive is used here
 
 # Configuration
 DATABASE_URL = "sqlite:///./tasks.db" # Relative to where backend.py runs
+ASYNC_DATABASE_URL = "sqlite+aiosqlite:///./tasks.db" # Same file, used by the FastAPI endpoints
+GDRIVE_DOWNLOAD_LEAD_TIME = timedelta(minutes=10) # GDrive files are fetched this long before printing
+POLL_BATCH_SIZE = 64 # Max tasks of each kind dispatched per poll
+DOWNLOAD_WORKERS = 8 # Bandwidth-bound GDrive downloads
+PRINT_WORKERS = 4 # lp calls, which block on CUPS
+ORPHANED_UPLOAD_GRACE_PERIOD = timedelta(hours=1) # Younger files may belong to an upload still in progress
+
+# Connection pool sizing. Kept above FastAPI's default threadpool (40) so bursts of
+# requests don't hit "QueuePool limit ... reached" timeouts.
+POOL_OPTIONS = {
+    "pool_size": 20,
+    "max_overflow": 40,
+    "pool_recycle": 3600,
+    "pool_timeout": 30,
+    "pool_pre_ping": True,
+}
 
 # Logging setup
 logger = logging.getLogger(__name__)
 
 # Database Setup (SQLAlchemy)
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+# Sync engine: used by the APScheduler jobs below, which run in worker threads.
+engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False}, **POOL_OPTIONS)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async engine: used by the request handlers so DB access doesn't block the event loop.
+async_engine = create_async_engine(ASYNC_DATABASE_URL, connect_args={"check_same_thread": False}, **POOL_OPTIONS)
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False, autoflush=False)
+
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets the API read tasks while a scheduler job is writing a status update.
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY") # Sorts/temp indexes stay off disk
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}") # Reads come from mapped pages instead of read() calls
+    cursor.close()
+
+event.listen(engine, "connect", _set_sqlite_pragmas)
+event.listen(async_engine.sync_engine, "connect", _set_sqlite_pragmas)
+
 Base = declarative_base() # This line remains the same, uses the updated import
 
 class StorageType(str, enum.Enum): # Changed to use enum.Enum
@@ -47,31 +91,85 @@ class Task(Base):
     color_mode = Column(String)
     page_size = Column(String)
     status = Column(SAEnum(TaskStatus, values_callable=lambda obj: [e.value for e in obj])) # Pass the enum class directly
-    created_at = Column(DateTime, default=datetime.now(timezone.utc))
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     error_message = Column(String, nullable=True)
 
-Base.metadata.create_all(bind=engine)
+    __table_args__ = (
+        Index("ix_tasks_created_at_desc", created_at.desc()), # list_tasks ordering
+        Index("ix_tasks_status_time_to_print", status, time_to_print), # poll_due_tasks
+    )
+
+def init_db():
+    # Called from the app's lifespan rather than at import, so importing this module
+    # (e.g. from tests or parallel test workers) doesn't create ./tasks.db.
+    Base.metadata.create_all(bind=engine)
+    # create_all skips existing tables along with their indexes, so databases created
+    # before an index was added to Task get it here.
+    for index in Task.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
 
 # Dependency to get DB session
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 # Task Functions
-def prepare_gdrive_download_task(task_id: int, scheduler_obj, gdrive_download_full_path_val: str):
+def _update_task(db, task_id: int, expected_status: Optional[TaskStatus] = None, **values) -> bool:
+    # One UPDATE + commit per state change; on SQLite every commit is an fsync,
+    # so the jobs below collect their changes and write them together. The commit
+    # expires loaded Task objects, so callers use task_id rather than task.id after it.
+    # With expected_status, the write only lands if the task is still in that state,
+    # so a job finishing late can't overwrite a status set elsewhere (e.g. by recovery).
+    statement = update(Task).where(Task.id == task_id)
+    if expected_status is not None:
+        statement = statement.where(Task.status == expected_status)
+    result = db.execute(statement.values(**values))
+    db.commit()
+    if result.rowcount == 0:
+        logger.warning(f"Task {task_id}: discarded update {values}; the task is gone or its status changed.")
+        return False
+    return True
+
+# One CUPS connection per print worker thread; pycups connections aren't thread-safe
+_cups_local = threading.local()
+
+def _cups_print(printer_name_val: str, file_path: str, title: str, options: dict):
+    connection = getattr(_cups_local, "connection", None)
+    if connection is None:
+        connection = _cups_local.connection = cups.Connection()
+    try:
+        return connection.printFile(printer_name_val, file_path, title, options)
+    except Exception:
+        _cups_local.connection = None # Reconnect on the next job (cupsd may have restarted)
+        raise
+
+def _lp_command(printer_name_val: str, file_path: str, options: dict) -> tuple:
+    option_args = tuple(arg for name, value in options.items() for arg in ("-o", f"{name}={value}"))
+    return ("lp", "-d", printer_name_val) + option_args + (file_path,)
+
+def _print_options(task) -> dict:
+    options = {}
+    if task.page_size:
+        options["media"] = task.page_size
+    if task.color_mode == "color":
+        options["ColorModel"] = "CMYK"
+    elif task.color_mode == "bw":
+        options["ColorModel"] = "Gray"
+    return options
+
+def prepare_gdrive_download_task(task_id: int, gdrive_download_full_path_val: str):
     db = SessionLocal()
-    task = db.query(Task).filter(Task.id == task_id).first()
+    task = db.get(Task, task_id)
 
     if not task:
         logger.error(f"PrepareGdriveDownload: Task ID {task_id} not found.")
         db.close()
         return
 
-    if task.status == TaskStatus.FAILED:
-        logger.info(f"PrepareGdriveDownload: Task {task_id} is already marked as FAILED. Skipping download.")
+    # poll_due_tasks claims the task (SCHEDULED -> DOWNLOADING) before dispatching it;
+    # anything else means another job already handled it.
+    if task.status != TaskStatus.DOWNLOADING:
+        logger.info(f"PrepareGdriveDownload: Task {task_id} is {task.status.value}, not claimed for download. Skipping.")
         db.close()
         return
 
@@ -81,66 +179,51 @@ def prepare_gdrive_download_task(task_id: int, scheduler_obj, gdrive_download_fu
         return
 
     logger.info(f"PrepareGdriveDownload: Starting download for task {task_id}, file ID {task.file_identifier}")
-    task.status = TaskStatus.DOWNLOADING
-    db.commit()
 
-    download_destination = os.path.join(gdrive_download_full_path_val, f"task_{task.id}_{task.original_filename}")
+    download_destination = os.path.join(gdrive_download_full_path_val, f"task_{task_id}_{task.original_filename}")
+    final_values = {}
 
     try:
         download_from_gdrive(task.file_identifier, download_destination)
-        task.gdrive_download_path = download_destination
-        task.status = TaskStatus.SCHEDULED # Ready for the print_file_task
+        final_values = {"gdrive_download_path": download_destination, "status": TaskStatus.SCHEDULED} # Ready for the print_file_task
         logger.info(f"PrepareGdriveDownload: File for task {task_id} downloaded to {download_destination}")
     except Exception as e:
         error_msg = f"PrepareGdriveDownload: Failed to download file for task {task_id} (ID: {task.file_identifier}): {e}"
         logger.error(error_msg)
-        task.status = TaskStatus.FAILED
-        task.error_message = str(e)
+        final_values = {"status": TaskStatus.FAILED, "error_message": str(e)}
         
         email_subject = f"Print Task Failed: {task.original_filename}"
         email_body = (
             f"Hello,\n\nThe file '{task.original_filename}' scheduled for printing could not be downloaded from Google Drive.\n"
             f"Error: {str(e)}\n\nYou may need to print this file manually.\n"
-            f"Task ID: {task.id}"
+            f"Task ID: {task_id}"
         )
         send_email(task.uploader_email, email_subject, email_body)
-
-        try:
-            scheduler_obj.remove_job(f"print_task_{task.id}")
-            logger.info(f"PrepareGdriveDownload: Removed scheduled print_task_{task.id} due to download failure.")
-        except JobLookupError:
-            logger.warning(f"PrepareGdriveDownload: Could not find print_task_{task.id} to remove.")
+        # No print job to cancel: poll_due_tasks only picks up SCHEDULED tasks.
     finally:
-        db.commit()
+        if final_values:
+            _update_task(db, task_id, TaskStatus.DOWNLOADING, **final_values)
         db.close()
 
 def print_file_task(task_id: int, printer_name_val: str):
     db = SessionLocal()
-    task = db.query(Task).filter(Task.id == task_id).first()
+    task = db.get(Task, task_id)
 
     if not task:
         logger.error(f"PrintTask: Task ID {task_id} not found for printing.")
         db.close()
         return
 
-    if task.status == TaskStatus.FAILED:
-        logger.info(f"PrintTask: Task {task_id} ({task.original_filename}) is marked FAILED. Skipping print.")
-        db.close()
-        return
-    
-    if task.status == TaskStatus.DOWNLOADING:
-        logger.warning(f"PrintTask: Task {task_id} ({task.original_filename}) is still DOWNLOADING. This implies an issue. Marking as FAILED.")
-        task.status = TaskStatus.FAILED
-        task.error_message = "Print task ran while file was still in downloading state or download failed to update status."
-        db.commit()
+    # poll_due_tasks claims the task (SCHEDULED -> PRINTING) before dispatching it;
+    # anything else (COMPLETED, FAILED, ...) must not be sent to the printer again.
+    if task.status != TaskStatus.PRINTING:
+        logger.info(f"PrintTask: Task {task_id} ({task.original_filename}) is {task.status.value}, not claimed for printing. Skipping print.")
         db.close()
         return
 
     if not printer_name_val:
         logger.error("PRINTER_NAME is not configured (passed as empty). Cannot print.")
-        task.status = TaskStatus.FAILED
-        task.error_message = "Printer name not configured (passed as empty)."
-        db.commit()
+        _update_task(db, task_id, TaskStatus.PRINTING, status=TaskStatus.FAILED, error_message="Printer name not configured (passed as empty).")
         db.close()
         return
 
@@ -156,71 +239,213 @@ def print_file_task(task_id: int, printer_name_val: str):
         else:
             error_msg = f"GDrive file {task.original_filename} (ID: {task.file_identifier}) not found locally at expected path {task.gdrive_download_path}. Download may have failed or path is incorrect."
             logger.error(f"PrintTask: {error_msg}")
-            task.status = TaskStatus.FAILED
-            task.error_message = error_msg
-            db.commit()
+            _update_task(db, task_id, TaskStatus.PRINTING, status=TaskStatus.FAILED, error_message=error_msg)
             db.close()
             return
     elif task.storage_type == StorageType.LOCAL:
         file_to_print_path = task.file_identifier
     else:
         logger.error(f"PrintTask: Unknown storage type for task {task_id}.")
-        task.status = TaskStatus.FAILED
-        task.error_message = "Unknown storage type."
-        db.commit()
+        _update_task(db, task_id, TaskStatus.PRINTING, status=TaskStatus.FAILED, error_message="Unknown storage type.")
         db.close()
         return
 
     if not os.path.exists(file_to_print_path):
         error_msg = f"File not found at {file_to_print_path} for task {task_id}."
         logger.error(f"PrintTask: {error_msg}")
-        task.status = TaskStatus.FAILED
-        task.error_message = error_msg
-        db.commit()
+        _update_task(db, task_id, TaskStatus.PRINTING, status=TaskStatus.FAILED, error_message=error_msg)
         db.close()
         return
-    
-    task.status = TaskStatus.PRINTING
-    db.commit()
 
-    try:
-        print_command = ["lp", "-d", printer_name_val]
-        if task.page_size:
-            print_command.extend(["-o", f"media={task.page_size}"])
-        
-        if task.color_mode == "color":
-            print_command.extend(["-o", "ColorModel=CMYK"])
-        elif task.color_mode == "bw":
-            print_command.extend(["-o", "ColorModel=Gray"])
-        
-        print_command.append(file_to_print_path)
+    # CUPS returns as soon as the job is spooled, so the task goes from PRINTING to
+    # its final state in a single commit.
+    final_values = {}
 
-        logger.info(f"PrintTask: Executing print command: {' '.join(print_command)}")
-        process = subprocess.run(print_command, capture_output=True, text=True, check=False)
+    try:
+        options = _print_options(task)
 
-        if process.returncode == 0:
-            logger.info(f"PrintTask: Successfully sent {task.original_filename} to printer {printer_name_val}.")
-            task.status = TaskStatus.COMPLETED
+        if cups is not None:
+            job_id = _cups_print(printer_name_val, file_to_print_path, task.original_filename, options)
+            logger.info(f"PrintTask: Successfully sent {task.original_filename} to printer {printer_name_val} (CUPS job {job_id}).")
+            final_values["status"] = TaskStatus.COMPLETED
         else:
-            error_msg = f"Printing failed for {task.original_filename}. Error: {process.stderr or process.stdout}"
-            logger.error(f"PrintTask: {error_msg}")
-            task.status = TaskStatus.FAILED
-            task.error_message = process.stderr or process.stdout or "Unknown printing error"
-        db.commit()
+            print_command = _lp_command(printer_name_val, file_to_print_path, options)
+            if logger.isEnabledFor(logging.INFO):
+                # shlex.join quotes paths with spaces so the logged command is unambiguous
+                logger.info("PrintTask: Executing print command: %s", shlex.join(print_command))
+            process = run_subprocess(print_command, capture_output=True, text=True, check=False)
+
+            if process.returncode == 0:
+                logger.info(f"PrintTask: Successfully sent {task.original_filename} to printer {printer_name_val}.")
+                final_values["status"] = TaskStatus.COMPLETED
+            else:
+                error_msg = f"Printing failed for {task.original_filename}. Error: {process.stderr or process.stdout}"
+                logger.error(f"PrintTask: {error_msg}")
+                final_values["status"] = TaskStatus.FAILED
+                final_values["error_message"] = process.stderr or process.stdout or "Unknown printing error"
 
     except Exception as e:
         error_msg = f"Error during print task {task_id}: {e}"
         logger.error(f"PrintTask: {error_msg}")
-        task.status = TaskStatus.FAILED
-        task.error_message = str(e)
-        db.commit()
+        final_values["status"] = TaskStatus.FAILED
+        final_values["error_message"] = str(e)
     finally:
         if is_gdrive_downloaded_file and os.path.exists(file_to_print_path):
             try:
                 os.remove(file_to_print_path)
                 logger.info(f"PrintTask: Cleaned up temporary GDrive downloaded file: {file_to_print_path}")
-                task.gdrive_download_path = None
-                db.commit()
+                final_values["gdrive_download_path"] = None
             except Exception as e_remove:
                 logger.error(f"PrintTask: Failed to remove temporary GDrive file {file_to_print_path}: {e_remove}")
+        if final_values:
+            _update_task(db, task_id, TaskStatus.PRINTING, **final_values)
+        db.close()
+
+INTERRUPTED_PRINT_ERROR = "Interrupted while printing; check the printer before resubmitting."
+
+def recover_interrupted_tasks():
+    # The tasks table is the schedule, so a restart loses nothing except jobs that
+    # were running: a task left in DOWNLOADING or PRINTING would never be polled again.
+    # Assumes this is the only process running jobs, so any claim found at startup
+    # belongs to a previous run.
+    db = SessionLocal()
+    try:
+        # Downloads are safe to repeat, so they go back to the queue.
+        downloads = db.execute(
+            update(Task)
+            .where(Task.status == TaskStatus.DOWNLOADING)
+            .values(status=TaskStatus.SCHEDULED, gdrive_download_path=None)
+        )
+        # A print may already have reached the printer; re-queueing it could print it
+        # twice, so it is failed for the uploader to check instead.
+        prints = db.execute(
+            update(Task)
+            .where(Task.status == TaskStatus.PRINTING)
+            .values(status=TaskStatus.FAILED, error_message=INTERRUPTED_PRINT_ERROR)
+        )
+        db.commit()
+        if downloads.rowcount:
+            logger.info(f"Recovery: Re-queued {downloads.rowcount} interrupted GDrive download(s).")
+        if prints.rowcount:
+            logger.warning(f"Recovery: Marked {prints.rowcount} interrupted print(s) as FAILED.")
+        return downloads.rowcount + prints.rowcount
+    finally:
         db.close()
+
+def remove_orphaned_uploads(local_storage_path: str):
+    # Upload files with no task row: the process stopped between writing the file and
+    # committing the task, or during a Drive upload. Run at startup, before requests.
+    # Files younger than the grace period are left alone in case their upload is
+    # still being handled (e.g. a restart overlapping the old process).
+    cutoff = (datetime.now(timezone.utc) - ORPHANED_UPLOAD_GRACE_PERIOD).timestamp()
+    db = SessionLocal()
+    try:
+        referenced = {
+            os.path.normpath(path)
+            for path in db.execute(select(Task.file_identifier).where(Task.storage_type == StorageType.LOCAL)).scalars()
+            if path
+        }
+    finally:
+        db.close()
+
+    for entry in os.scandir(local_storage_path):
+        if not entry.is_file():
+            continue
+        is_orphan = entry.name.startswith("temp_") or (
+            entry.name.startswith("local_") and os.path.normpath(entry.path) not in referenced
+        )
+        if is_orphan and entry.stat().st_mtime > cutoff:
+            continue
+        if is_orphan:
+            try:
+                os.remove(entry.path)
+                logger.info(f"Cleanup: Removed orphaned upload {entry.path}")
+            except OSError as e:
+                logger.error(f"Cleanup: Failed to remove orphaned upload {entry.path}: {e}")
+
+# Task dispatch
+# A single recurring poll replaces per-task scheduler jobs: the tasks table is the
+# schedule, and due work is handed to a bounded thread pool.
+# Downloads and prints get separate pools so a stalled printer can't hold up
+# downloads (or a slow download hold up printing).
+download_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="download")
+print_executor = ThreadPoolExecutor(max_workers=PRINT_WORKERS, thread_name_prefix="print")
+
+def _claim_task(db, task_id: int, claimed_status: TaskStatus, *criteria) -> bool:
+    # Conditional UPDATE: a task moves out of SCHEDULED once, so a poll that reads it
+    # again while its job is queued or running can't dispatch it a second time.
+    # Single process only: startup recovery treats every claim as interrupted.
+    result = db.execute(
+        update(Task)
+        .where(Task.id == task_id, Task.status == TaskStatus.SCHEDULED, *criteria)
+        .values(status=claimed_status)
+    )
+    return result.rowcount == 1
+
+def _release_claim(task_id: int):
+    # The job never started, so hand the task back to the poller rather than leaving it
+    # claimed (recover_interrupted_tasks would fail a PRINTING task it can't tell apart).
+    db = SessionLocal()
+    try:
+        db.execute(
+            update(Task)
+            .where(Task.id == task_id, Task.status.in_([TaskStatus.DOWNLOADING, TaskStatus.PRINTING]))
+            .values(status=TaskStatus.SCHEDULED)
+        )
+        db.commit()
+    finally:
+        db.close()
+
+def _task_done(task_id: int, future):
+    if future.cancelled(): # Queued job dropped by executor shutdown
+        _release_claim(task_id)
+        return
+    if future.exception() is not None:
+        logger.error(f"Dispatch: Job for task {task_id} raised: {future.exception()}")
+
+def _dispatch_task(executor, func, task_id: int, *args):
+    future = executor.submit(func, task_id, *args)
+    future.add_done_callback(lambda f: _task_done(task_id, f))
+
+def poll_due_tasks(gdrive_download_full_path_val: str, printer_name_val: str):
+    now = datetime.now(timezone.utc)
+    db = SessionLocal()
+    try:
+        download_ids = db.execute(
+            select(Task.id)
+            .where(
+                Task.status == TaskStatus.SCHEDULED,
+                Task.storage_type == StorageType.GDRIVE,
+                Task.gdrive_download_path.is_(None),
+                Task.time_to_print <= now + GDRIVE_DOWNLOAD_LEAD_TIME,
+            )
+            .order_by(Task.time_to_print)
+            .limit(POLL_BATCH_SIZE)
+        ).scalars().all()
+        print_ids = db.execute(
+            select(Task.id)
+            .where(
+                Task.status == TaskStatus.SCHEDULED,
+                or_(Task.storage_type == StorageType.LOCAL, Task.gdrive_download_path.is_not(None)),
+                Task.time_to_print <= now,
+            )
+            .order_by(Task.time_to_print)
+            .limit(POLL_BATCH_SIZE)
+        ).scalars().all()
+        # Claim everything in one transaction and commit before dispatching, so the
+        # jobs (on their own sessions) see the claimed status.
+        download_ids = [
+            task_id for task_id in download_ids
+            if _claim_task(db, task_id, TaskStatus.DOWNLOADING, Task.gdrive_download_path.is_(None))
+        ]
+        print_ids = [task_id for task_id in print_ids if _claim_task(db, task_id, TaskStatus.PRINTING)]
+        db.commit()
+    finally:
+        db.close()
+
+    for task_id in download_ids:
+        _dispatch_task(download_executor, prepare_gdrive_download_task, task_id, gdrive_download_full_path_val)
+        logger.info(f"Poll: Dispatched GDrive download for task {task_id}.")
+    for task_id in print_ids:
+        _dispatch_task(print_executor, print_file_task, task_id, printer_name_val)
+        logger.info(f"Poll: Dispatched print for task {task_id}.")
@@ -1,6 +1,7 @@
 import os
 import logging
 import smtplib
+import threading
 from email.mime.text import MIMEText
 
 from google.oauth2.service_account import Credentials
@@ -15,6 +16,7 @@ logger = logging.getLogger(__name__)
 # Google Drive Configuration
 GDRIVE_CREDENTIALS_FILE = "credentials.json"
 GDRIVE_FOLDER_ID = os.getenv("GDRIVE_FOLDER_ID")
+GDRIVE_CHUNK_SIZE = 16 * 1024 * 1024 # Resumable upload/download chunk size (multiple of 256 KiB)
 
 # Email Configuration
 SMTP_SERVER = os.getenv("SMTP_SERVER")
@@ -24,16 +26,35 @@ SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
 SENDER_EMAIL = os.getenv("SENDER_EMAIL")
 
 
+# Credentials are loaded once per process. The Drive service itself is cached per
+# thread because googleapiclient's httplib2 transport is not thread-safe, and the
+# API request handlers and scheduler jobs run on different threads.
+_gdrive_credentials = None
+_gdrive_credentials_lock = threading.Lock()
+_gdrive_local = threading.local()
+
+
+def _get_gdrive_credentials():
+    global _gdrive_credentials
+    with _gdrive_credentials_lock:
+        if _gdrive_credentials is None:
+            _gdrive_credentials = Credentials.from_service_account_file(
+                GDRIVE_CREDENTIALS_FILE,
+                scopes=['https://www.googleapis.com/auth/drive.file']
+            )
+        return _gdrive_credentials
+
 def get_gdrive_service():
+    service = getattr(_gdrive_local, "service", None)
+    if service is not None:
+        return service
     try:
         if not os.path.exists(GDRIVE_CREDENTIALS_FILE):
             logger.error(f"{GDRIVE_CREDENTIALS_FILE} not found.")
             return None
-        creds = Credentials.from_service_account_file(
-            GDRIVE_CREDENTIALS_FILE,
-            scopes=['https://www.googleapis.com/auth/drive.file']
-        )
-        service = build('drive', 'v3', credentials=creds)
+        creds = _get_gdrive_credentials()
+        service = build('drive', 'v3', credentials=creds, cache_discovery=False)
+        _gdrive_local.service = service # Failures aren't cached, so a later call can retry
         return service
     except Exception as e:
         logger.error(f"Failed to initialize Google Drive service: {e}")
@@ -52,7 +73,7 @@ def upload_to_gdrive(file_path: str, filename: str):
             'name': filename,
             'parents': [GDRIVE_FOLDER_ID]
         }
-        media = MediaFileUpload(file_path, resumable=True)
+        media = MediaFileUpload(file_path, chunksize=GDRIVE_CHUNK_SIZE, resumable=True)
         file = service.files().create(body=file_metadata, media_body=media, fields='id').execute()
         logger.info(f"File {filename} uploaded to Google Drive with ID: {file.get('id')}")
         return file.get('id')
@@ -68,7 +89,7 @@ def download_from_gdrive(file_id: str, destination_path: str):
         request = service.files().get_media(fileId=file_id)
         os.makedirs(os.path.dirname(destination_path), exist_ok=True) # Ensure directory exists
         with open(destination_path, 'wb') as fh:
-            downloader = MediaIoBaseDownload(fh, request)
+            downloader = MediaIoBaseDownload(fh, request, chunksize=GDRIVE_CHUNK_SIZE)
             done = False
             while not done:
                 status, done = downloader.next_chunk()
@@ -82,7 +103,43 @@ def download_from_gdrive(file_id: str, destination_path: str):
             os.remove(destination_path)
         raise # Re-raise the exception
 
+# One authenticated SMTP connection is reused across notifications (e.g. a Drive
+# outage failing many tasks at once) instead of a TCP + STARTTLS + AUTH per email.
+_smtp = None
+_smtp_lock = threading.Lock()
+
+# The server rejected this message, but the session is still usable for the next one
+SMTP_MESSAGE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+
+
+def _smtp_discard(server):
+    try:
+        server.close()
+    except Exception:
+        pass # Socket already gone
+
+def _smtp_connect():
+    server = smtplib.SMTP(SMTP_SERVER, int(SMTP_PORT), timeout=30)
+    try:
+        server.starttls()  # Enable security
+        server.login(SMTP_USERNAME, SMTP_PASSWORD)
+    except Exception:
+        _smtp_discard(server)
+        raise
+    return server
+
+def close_smtp_connection():
+    global _smtp
+    with _smtp_lock:
+        if _smtp is not None:
+            try:
+                _smtp.quit()
+            except Exception:
+                pass # Already closed by the server
+            _smtp = None
+
 def send_email(to_email: str, subject: str, body: str):
+    global _smtp
     if not all([SMTP_SERVER, SMTP_PORT, SMTP_USERNAME, SMTP_PASSWORD, SENDER_EMAIL]):
         logger.error("SMTP settings not fully configured. Cannot send email.")
         return False
@@ -92,14 +149,26 @@ def send_email(to_email: str, subject: str, body: str):
     msg['From'] = SENDER_EMAIL
     msg['To'] = to_email
 
-    try:
-        with smtplib.SMTP(SMTP_SERVER, int(SMTP_PORT)) as server:
-            server.starttls()  # Enable security
-            server.login(SMTP_USERNAME, SMTP_PASSWORD)
-            server.sendmail(SENDER_EMAIL, to_email, msg.as_string())
-        logger.info(f"Email sent to {to_email} with subject: {subject}")
-        return True
-    except Exception as e:
-        logger.error(f"Failed to send email to {to_email}: {e}")
-        return False
-
+    with _smtp_lock:
+        try:
+            if _smtp is None:
+                _smtp = _smtp_connect()
+            try:
+                _smtp.sendmail(SENDER_EMAIL, to_email, msg.as_string())
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                # Servers drop idle connections; reconnect once and retry
+                _smtp_discard(_smtp)
+                _smtp = None
+                _smtp = _smtp_connect()
+                _smtp.sendmail(SENDER_EMAIL, to_email, msg.as_string())
+            logger.info(f"Email sent to {to_email} with subject: {subject}")
+            return True
+        except SMTP_MESSAGE_ERRORS as e:
+            logger.error(f"Failed to send email to {to_email}: {e}")
+            return False
+        except Exception as e:
+            logger.error(f"Failed to send email to {to_email}: {e}")
+            if _smtp is not None:
+                _smtp_discard(_smtp) # Don't reuse a connection in an unknown state
+                _smtp = None
+            return False
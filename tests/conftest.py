@@ -1,53 +1,101 @@
 import os
 import pytest
-import asyncio
+from datetime import datetime, timezone
 from httpx import AsyncClient, ASGITransport 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from typing import AsyncGenerator, Generator
 import pytest_asyncio 
-from unittest.mock import MagicMock 
+from unittest.mock import DEFAULT, MagicMock, patch
 
+import backend
 from backend import app  
 import db as app_db 
 from db import Base, get_db, Task 
 import helper as app_helper 
 
-TEST_DATABASE_URL = "sqlite:///./test.db"
+# Each pytest-xdist worker gets its own in-memory database. The
+# shared-cache URI lets the sync job sessions and the aiosqlite API session (which runs
+# on its own thread) see the same database without touching disk.
+WORKER_ID = os.environ.get("PYTEST_XDIST_WORKER", "gw0")
+TEST_DB_URI = f"file:testdb_{WORKER_ID}?mode=memory&cache=shared&uri=true"
+TEST_DATABASE_URL = f"sqlite:///{TEST_DB_URI}"
+TEST_ASYNC_DATABASE_URL = f"sqlite+aiosqlite:///{TEST_DB_URI}"
 
-engine = create_engine(TEST_DATABASE_URL, connect_args={"check_same_thread": False})
+engine = create_engine(TEST_DATABASE_URL, connect_args={"check_same_thread": False}, poolclass=QueuePool)
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = create_async_engine(TEST_ASYNC_DATABASE_URL, connect_args={"check_same_thread": False}, poolclass=StaticPool)
+TestingAsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False, autoflush=False)
+
+@event.listens_for(engine, "connect")
+@event.listens_for(async_engine.sync_engine, "connect")
+def _set_test_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA synchronous=OFF")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
 @pytest.fixture(scope="session", autouse=True)
 def setup_test_database():
-    if os.path.exists("./test.db"):
-        os.remove("./test.db")
-    Base.metadata.create_all(bind=engine)
-    yield
-    if os.path.exists("./test.db"):
-        os.remove("./test.db")
-
-@pytest.fixture
-def override_get_db() -> Generator:
-    try:
-        db = TestingSessionLocal()
+    # The in-memory database lives only while a connection to it is open
+    with engine.connect() as keepalive:
+        Base.metadata.create_all(bind=keepalive)
+        keepalive.commit()
+        yield
+
+async def override_get_db() -> AsyncGenerator[AsyncSession, None]:
+    async with TestingAsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 @pytest.fixture(autouse=True)
-def apply_db_override(override_get_db):
-    app.dependency_overrides[get_db] = lambda: override_get_db
+def apply_db_override():
+    app.dependency_overrides[get_db] = override_get_db
 
-@pytest_asyncio.fixture
+@pytest.fixture(autouse=True)
+def gdrive_available_state():
+    # The lifespan (which normally probes Google Drive) doesn't run under ASGITransport
+    app.state.gdrive_ok = True
+    app.state.gdrive_checked_at = float("-inf") # Next re-probe isn't rate-limited
+    yield
+    app.state.gdrive_ok = True
+
+@pytest_asyncio.fixture(scope="session", loop_scope="session")
 async def client() -> AsyncGenerator[AsyncClient, None]:
-    # Use ASGITransport for httpx.AsyncClient with a FastAPI app
+    # Use ASGITransport for httpx.AsyncClient with a FastAPI app. One client for the
+    # whole run; per-test state lives in the database, which is cleared between tests.
     async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
         yield ac
 
+# Fixed "now" for the app and the tests, so scheduled times are constants rather than
+# wall-clock reads that drift while a test runs
+FROZEN_NOW = datetime(2025, 1, 1, 12, 0, tzinfo=timezone.utc)
+
+class _FrozenDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return FROZEN_NOW.astimezone(tz) if tz else FROZEN_NOW.replace(tzinfo=None)
+
+@pytest.fixture(autouse=True)
+def frozen_clock(monkeypatch):
+    monkeypatch.setattr(app_db, "datetime", _FrozenDatetime)
+    monkeypatch.setattr(backend, "datetime", _FrozenDatetime)
+    return FROZEN_NOW
+
+@pytest.fixture(autouse=True)
+def clear_tasks_before_each_test():
+    # The API and the job functions commit on their own connections, so a per-test
+    # rollback can't undo their writes; empty the table instead.
+    with engine.begin() as conn:
+        conn.execute(Task.__table__.delete())
+
 @pytest.fixture
 def db_session() -> Generator:
-    db = TestingSessionLocal()
+    # Keep attributes loaded after commit so tests can read task.id etc. without a
+    # reload; tests still refresh explicitly after the code under test writes.
+    db = TestingSessionLocal(expire_on_commit=False)
     try:
         yield db
     finally:
@@ -58,15 +106,14 @@ def patch_db_session_local(mocker):
     mocker.patch.object(app_db, 'SessionLocal', TestingSessionLocal)
 
 @pytest.fixture(autouse=True)
-def mock_scheduler(mocker):
-    mock_add_job = mocker.patch('apscheduler.schedulers.background.BackgroundScheduler.add_job')
-    mock_remove_job = mocker.patch('apscheduler.schedulers.background.BackgroundScheduler.remove_job')
-    return {"add_job": mock_add_job, "remove_job": mock_remove_job}
+def mock_scheduler_add_job(mocker):
+    # The only scheduler job is the poller added at startup; tasks must never add their own
+    return mocker.patch('apscheduler.schedulers.background.BackgroundScheduler.add_job', autospec=True)
 
 @pytest.fixture(autouse=True)
 def mock_helper_upload(mocker):
     # Patch where upload_to_gdrive is LOOKED UP and USED by the code under test (backend.py)
-    return mocker.patch('backend.upload_to_gdrive', return_value="mock_gdrive_file_id_123")
+    return mocker.patch('backend.upload_to_gdrive', autospec=True, return_value="mock_gdrive_file_id_123")
 
 @pytest.fixture(autouse=True) 
 def mock_get_gdrive_service(mocker): 
@@ -74,10 +121,10 @@ def mock_get_gdrive_service(mocker):
     # This mock is primarily to ensure get_gdrive_service() in helper.py returns a mock object 
     # instead of None or erroring out due to missing credentials.json in tests. 
     # The actual download simulation is handled by mock_helper_download. 
-    return mocker.patch.object(app_helper, 'get_gdrive_service', return_value=mock_service)
+    return mocker.patch.object(app_helper, 'get_gdrive_service', autospec=True, return_value=mock_service)
 
 @pytest.fixture(autouse=True)
-def mock_helper_download(mocker):
+def mock_helper_download(mocker, request):
     def mock_download_behavior(file_id, destination_path):
         os.makedirs(os.path.dirname(destination_path), exist_ok=True)
         with open(destination_path, "w") as f:
@@ -86,13 +133,24 @@ def mock_helper_download(mocker):
     
     # Patch where download_from_gdrive is LOOKED UP and USED, which is in the 'db' module.
     # db.py imports download_from_gdrive from helper.
-    return mocker.patch('db.download_from_gdrive', side_effect=mock_download_behavior)
+    # Tests can parametrize this fixture indirectly with an exception to raise instead.
+    side_effect = getattr(request, "param", None) or mock_download_behavior
+    return mocker.patch('db.download_from_gdrive', autospec=True, side_effect=side_effect)
 
-@pytest.fixture(autouse=True)
-def mock_helper_send_email(mocker):
+@pytest.fixture(scope="session")
+def _send_email_patch():
     # Patch where send_email is LOOKED UP and USED.
     # It's imported into db.py as `from helper import send_email`.
-    return mocker.patch('db.send_email', return_value=True)
+    with patch('db.send_email', autospec=True) as mock_send_email:
+        yield mock_send_email
+
+@pytest.fixture(autouse=True)
+def mock_helper_send_email(_send_email_patch):
+    # Patched once per session; only the recorded calls and configuration are reset per test
+    _send_email_patch.reset_mock()
+    _send_email_patch.side_effect = None
+    _send_email_patch.return_value = True
+    return _send_email_patch
 
 @pytest.fixture(autouse=True)
 def mock_os_path_exists_for_credentials(mocker):
@@ -107,13 +165,35 @@ def mock_os_path_exists_for_credentials(mocker):
     return mocker.patch('os.path.exists', side_effect=side_effect)
 
 @pytest.fixture(autouse=True)
-def mock_subprocess_run(mocker):
-    # Mock subprocess.run to simulate successful print command
-    mock_process = mocker.Mock()
-    mock_process.returncode = 0
-    mock_process.stdout = "Successfully printed."
-    mock_process.stderr = ""
-    return mocker.patch('subprocess.run', return_value=mock_process)
+def disable_pycups(mocker):
+    # Exercise the lp fallback by default, even where pycups is installed
+    return mocker.patch.object(app_db, 'cups', None)
+
+@pytest.fixture(scope="session")
+def _subprocess_run_patch():
+    # Patched where db looks it up, so the real subprocess.run stays intact for
+    # everything else in the session (plugins, fixtures, libraries)
+    with patch('db.run_subprocess', autospec=True) as mock_run:
+        yield mock_run
+
+@pytest.fixture(autouse=True)
+def mock_subprocess_run(_subprocess_run_patch):
+    # Mock db's subprocess.run to simulate successful print command. The patch is installed
+    # once per session; each test gets a reset mock with a fresh successful result.
+    _subprocess_run_patch.reset_mock()
+    _subprocess_run_patch.side_effect = None
+    _subprocess_run_patch.return_value = MagicMock(returncode=0, stdout="Successfully printed.", stderr="")
+    return _subprocess_run_patch
+
+@pytest.fixture
+def lp_commands(mock_subprocess_run) -> list:
+    # Record each command passed to subprocess.run, still returning the mock's result
+    commands = []
+    def capture(cmd, *args, **kwargs):
+        commands.append(cmd)
+        return DEFAULT
+    mock_subprocess_run.side_effect = capture
+    return commands
 
 # Set necessary environment variables for tests if not already set
 # These are used by the main application code during import or runtime
@@ -125,28 +205,39 @@ os.environ["SMTP_USERNAME"] = "user@test.com"
 os.environ["SMTP_PASSWORD"] = "password"
 os.environ["SENDER_EMAIL"] = "sender@test.com"
 
-# Ensure test upload directories exist
-TEST_LOCAL_STORAGE_PATH = "test_uploads"
-TEST_GDRIVE_DOWNLOAD_FULL_PATH = os.path.join(TEST_LOCAL_STORAGE_PATH, "gdrive_downloads")
+# Size limit the large-file tests patch into backend, so the Google Drive branch
+# is reached without building a multi-MB upload
+TEST_MAX_FILE_SIZE_BYTES = 1024
 
-@pytest.fixture(scope="session", autouse=True)
-def setup_test_upload_dirs():
-    os.makedirs(TEST_LOCAL_STORAGE_PATH, exist_ok=True)
-    os.makedirs(TEST_GDRIVE_DOWNLOAD_FULL_PATH, exist_ok=True)
-    # Override paths in backend.py for testing if they are module-level constants
-    # This is tricky; ideally, paths are configurable or passed around.
-    # For now, we assume the test tasks will use paths passed to them or mocked.
-    import backend
-    backend.LOCAL_STORAGE_PATH = TEST_LOCAL_STORAGE_PATH
-    backend.GDRIVE_DOWNLOAD_FULL_PATH = TEST_GDRIVE_DOWNLOAD_FULL_PATH
-    yield
-    # Clean up test upload directories
-    # shutil.rmtree(TEST_LOCAL_STORAGE_PATH) # Be careful with rmtree
+@pytest.fixture(scope="session")
+def large_file_bytes() -> bytes:
+    return b"a" * (TEST_MAX_FILE_SIZE_BYTES + 100)
+
+@pytest.fixture(scope="session")
+def large_file_path(tmp_path_factory, large_file_bytes):
+    path = tmp_path_factory.mktemp("big") / "large.bin"
+    path.write_bytes(large_file_bytes)
+    return path
+
+SMALL_FILE_CONTENT = b"This is a small test file."
 
-# Required for pytest-asyncio to work with async fixtures and tests
 @pytest.fixture(scope="session")
-def event_loop(request): # Changed to accept request for pytest-asyncio compatibility if needed
-    """Create an instance of the default event loop for each test case."""
-    loop = asyncio.get_event_loop_policy().new_event_loop()
-    yield loop
-    loop.close()
+def small_file_path(tmp_path_factory):
+    path = tmp_path_factory.mktemp("small") / "small_test.txt"
+    path.write_bytes(SMALL_FILE_CONTENT)
+    return path
+
+@pytest.fixture(autouse=True)
+def local_storage_path(tmp_path, monkeypatch) -> str:
+    # Fresh upload directory per test; pytest removes it, so tests need no file cleanup
+    path = tmp_path / "uploads"
+    path.mkdir()
+    monkeypatch.setattr(backend, "LOCAL_STORAGE_PATH", str(path))
+    return str(path)
+
+@pytest.fixture(autouse=True)
+def gdrive_download_path(local_storage_path, monkeypatch) -> str:
+    path = os.path.join(local_storage_path, backend.GDRIVE_DOWNLOAD_SUBDIR)
+    os.makedirs(path)
+    monkeypatch.setattr(backend, "GDRIVE_DOWNLOAD_FULL_PATH", path)
+    return path
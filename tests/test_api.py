@@ -1,29 +1,31 @@
 import pytest
+import io
 import os
+from fastapi import HTTPException, UploadFile
 from httpx import AsyncClient
 from datetime import datetime, timezone, timedelta
+from sqlalchemy import insert
 from sqlalchemy.orm import Session
 
+import backend
+from backend import add_task
 from db import Task, TaskStatus, StorageType # Import your models
-from tests.conftest import TEST_LOCAL_STORAGE_PATH, TEST_GDRIVE_DOWNLOAD_FULL_PATH # For path checks
+from tests.conftest import FROZEN_NOW, SMALL_FILE_CONTENT, TEST_MAX_FILE_SIZE_BYTES
 
-# Mark all tests in this module as asyncio
-pytestmark = pytest.mark.asyncio
+# Mark all tests in this module as asyncio, sharing the session loop with the client fixture
+pytestmark = pytest.mark.asyncio(loop_scope="session")
 
-@pytest.fixture(autouse=True)
-def clear_tasks_before_each_test(db_session: Session):
-    db_session.query(Task).delete()
-    db_session.commit()
+@pytest.fixture
+def small_size_limit(monkeypatch):
+    # Trip the large-file (Google Drive) branch without building a multi-MB upload
+    monkeypatch.setattr("backend.MAX_FILE_SIZE_BYTES", TEST_MAX_FILE_SIZE_BYTES)
+    return TEST_MAX_FILE_SIZE_BYTES
 
-async def test_add_task_small_file(client: AsyncClient, mock_scheduler, db_session: Session):
-    print_time = datetime.now(timezone.utc) + timedelta(minutes=15)
+async def test_add_task_small_file(client: AsyncClient, mock_scheduler_add_job, db_session: Session, small_file_path):
+    print_time = FROZEN_NOW + timedelta(minutes=15)
     print_time_ts = int(print_time.timestamp())
 
-    # Create a dummy small file
-    dummy_file_content = b"This is a small test file."
     dummy_file_name = "small_test.txt"
-    
-    files = {'file': (dummy_file_name, dummy_file_content, 'text/plain')}
     data = {
         "time_to_print_ts": print_time_ts,
         "color_mode": "bw",
@@ -31,7 +33,9 @@ async def test_add_task_small_file(client: AsyncClient, mock_scheduler, db_sessi
         "uploader_email": "test@example.com"
     }
 
-    response = await client.post("/add-task/", files=files, data=data)
+    with small_file_path.open('rb') as small_file:
+        files = {'file': (dummy_file_name, small_file, 'text/plain')}
+        response = await client.post("/add-task/", files=files, data=data)
     
     assert response.status_code == 200
     response_data = response.json()
@@ -46,29 +50,39 @@ async def test_add_task_small_file(client: AsyncClient, mock_scheduler, db_sessi
     assert task_in_db.original_filename == dummy_file_name
     assert task_in_db.storage_type == StorageType.LOCAL
     assert task_in_db.uploader_email == "test@example.com"
-    assert os.path.exists(task_in_db.file_identifier) # Check if local file was saved
+    with open(task_in_db.file_identifier, "rb") as saved: # Check the local file was saved intact
+        assert saved.read() == SMALL_FILE_CONTENT
+
+    # No per-task jobs: poll_due_tasks picks SCHEDULED tasks up from the table
+    mock_scheduler_add_job.assert_not_called()
+    assert task_in_db.status == TaskStatus.SCHEDULED
+    assert int(task_in_db.time_to_print.replace(tzinfo=timezone.utc).timestamp()) == print_time_ts
+
+
+async def test_add_task_strips_path_from_filename(client: AsyncClient, db_session: Session, local_storage_path):
+    print_time_ts = int((FROZEN_NOW + timedelta(minutes=15)).timestamp())
+    files = {'file': ("../../escape.txt", b"traversal attempt", 'text/plain')}
+    data = {
+        "time_to_print_ts": print_time_ts,
+        "color_mode": "bw",
+        "page_size": "A4",
+        "uploader_email": "test@example.com"
+    }
 
-    # Verify scheduler calls
-    assert mock_scheduler["add_job"].call_count == 1 # Only print_file_task for local files
-    call_args = mock_scheduler["add_job"].call_args_list[0]
-    assert call_args[1]['args'][0] == task_id # task_id
-    assert call_args[1]['run_date'].timestamp() == pytest.approx(print_time_ts)
+    response = await client.post("/add-task/", files=files, data=data)
 
-    # Clean up the created file
-    if task_in_db and task_in_db.file_identifier and os.path.exists(task_in_db.file_identifier):
-        os.remove(task_in_db.file_identifier)
+    assert response.status_code == 200
+    assert response.json()["filename"] == "escape.txt"
+    task_in_db = db_session.query(Task).filter(Task.id == response.json()["task_id"]).first()
+    assert task_in_db.original_filename == "escape.txt"
+    assert os.path.dirname(task_in_db.file_identifier) == local_storage_path
 
 
-async def test_add_task_large_file(client: AsyncClient, mock_scheduler, mock_helper_upload, db_session: Session):
-    from backend import MAX_FILE_SIZE_BYTES # Get this from backend config
-    print_time = datetime.now(timezone.utc) + timedelta(minutes=20)
+async def test_add_task_large_file(client: AsyncClient, mock_scheduler_add_job, mock_helper_upload, db_session: Session, small_size_limit, large_file_path):
+    print_time = FROZEN_NOW + timedelta(minutes=20)
     print_time_ts = int(print_time.timestamp())
 
-    # Create a dummy large file (content doesn't matter as much as size for the check)
-    dummy_file_content = b"a" * (MAX_FILE_SIZE_BYTES + 100) 
     dummy_file_name = "large_test.txt"
-    
-    files = {'file': (dummy_file_name, dummy_file_content, 'text/plain')}
     data = {
         "time_to_print_ts": print_time_ts,
         "color_mode": "color",
@@ -76,7 +90,9 @@ async def test_add_task_large_file(client: AsyncClient, mock_scheduler, mock_hel
         "uploader_email": "largeuploader@example.com"
     }
 
-    response = await client.post("/add-task/", files=files, data=data)
+    with large_file_path.open('rb') as large_file:
+        files = {'file': (dummy_file_name, large_file, 'text/plain')}
+        response = await client.post("/add-task/", files=files, data=data)
     
     assert response.status_code == 200
     response_data = response.json()
@@ -90,59 +106,81 @@ async def test_add_task_large_file(client: AsyncClient, mock_scheduler, mock_hel
     assert task_in_db.storage_type == StorageType.GDRIVE
     assert task_in_db.file_identifier == "mock_gdrive_file_id_123" # From mock_helper_upload
 
-    # Verify scheduler calls (download + print)
-    assert mock_scheduler["add_job"].call_count == 2
-    
-    # Check download_task scheduling
-    download_call_args = mock_scheduler["add_job"].call_args_list[0] # Assuming download is scheduled first
-    assert download_call_args[1]['id'] == f"download_task_{task_id}"
-    assert download_call_args[1]['args'][0] == task_id # task_id
-    assert download_call_args[1]['args'][2] == TEST_GDRIVE_DOWNLOAD_FULL_PATH # Check path passed
-    expected_download_time = print_time - timedelta(minutes=10)
-    assert download_call_args[1]['run_date'].timestamp() == pytest.approx(expected_download_time.timestamp())
-
-    # Check print_task scheduling
-    print_call_args = mock_scheduler["add_job"].call_args_list[1]
-    assert print_call_args[1]['id'] == f"print_task_{task_id}"
-    assert print_call_args[1]['args'][0] == task_id # task_id
-    assert print_call_args[1]['run_date'].timestamp() == pytest.approx(print_time_ts)
-
-
-async def test_add_task_invalid_time(client: AsyncClient):
-    past_time_ts = int((datetime.now(timezone.utc) - timedelta(minutes=5)).timestamp())
-    files = {'file': ('test.txt', b"content", 'text/plain')}
+    # Download and print are both driven by poll_due_tasks, not per-task jobs
+    mock_scheduler_add_job.assert_not_called()
+    assert task_in_db.status == TaskStatus.SCHEDULED
+    assert task_in_db.gdrive_download_path is None
+    assert int(task_in_db.time_to_print.replace(tzinfo=timezone.utc).timestamp()) == print_time_ts
+
+
+async def test_add_task_large_file_gdrive_unavailable(client: AsyncClient, mock_helper_upload, mocker, small_size_limit, large_file_path):
+    from backend import app
+    app.state.gdrive_ok = False
+    mock_probe = mocker.patch('backend.get_gdrive_service', return_value=None)
+    print_time_ts = int((FROZEN_NOW + timedelta(minutes=20)).timestamp())
+
     data = {
-        "time_to_print_ts": past_time_ts,
+        "time_to_print_ts": print_time_ts,
         "color_mode": "bw",
         "page_size": "A4",
-        "uploader_email": "timererror@example.com"
+        "uploader_email": "largeuploader@example.com"
     }
-    response = await client.post("/add-task/", files=files, data=data)
-    assert response.status_code == 400
-    assert "time_to_print must be in the future" in response.json()["detail"]
-
 
-async def test_get_task_status(client: AsyncClient, db_session: Session):
+    with large_file_path.open('rb') as large_file:
+        files = {'file': ("large_test.txt", large_file, 'text/plain')}
+        response = await client.post("/add-task/", files=files, data=data)
+
+    assert response.status_code == 413
+    assert "Google Drive is not configured" in response.json()["detail"]
+    mock_probe.assert_called_once() # Re-probed because the cached flag was False
+    mock_helper_upload.assert_not_called()
+
+    # A second large upload during the outage doesn't rebuild the Drive client again
+    with large_file_path.open('rb') as large_file:
+        files = {'file': ("large_test.txt", large_file, 'text/plain')}
+        response = await client.post("/add-task/", files=files, data=data)
+
+    assert response.status_code == 413
+    mock_probe.assert_called_once()
+
+
+async def test_add_task_invalid_time(local_storage_path):
+    # Validation-only path: call the handler directly, no HTTP round trip or multipart parsing
+    past_time_ts = int((FROZEN_NOW - timedelta(minutes=5)).timestamp())
+    upload = UploadFile(file=io.BytesIO(b"content"), filename="test.txt")
+    with pytest.raises(HTTPException) as exc_info:
+        await add_task(
+            file=upload,
+            time_to_print_ts=past_time_ts,
+            color_mode="bw",
+            page_size="A4",
+            uploader_email="timererror@example.com",
+            db=None, # Rejected before the session is used
+        )
+    assert exc_info.value.status_code == 400
+    assert "time_to_print must be in the future" in exc_info.value.detail
+    assert os.listdir(local_storage_path) == [backend.GDRIVE_DOWNLOAD_SUBDIR] # Rejected before anything was written
+
+
+async def test_get_task_status(client: AsyncClient, db_session: Session, local_storage_path):
     # First, add a task
-    print_time = datetime.now(timezone.utc) + timedelta(hours=1)
+    print_time = FROZEN_NOW + timedelta(hours=1)
     task = Task(
         original_filename="retrievable.txt",
         uploader_email="retriever@example.com",
         storage_type=StorageType.LOCAL,
-        file_identifier=os.path.join(TEST_LOCAL_STORAGE_PATH, "retrievable.txt"),
+        file_identifier=os.path.join(local_storage_path, "retrievable.txt"),
         time_to_print=print_time,
         color_mode="bw",
         page_size="A4",
         status=TaskStatus.SCHEDULED
     )
     # Create a dummy file for the task
-    os.makedirs(TEST_LOCAL_STORAGE_PATH, exist_ok=True)
     with open(task.file_identifier, "w") as f:
         f.write("dummy content for retrieval test")
 
     db_session.add(task)
     db_session.commit()
-    db_session.refresh(task)
     task_id = task.id
 
     response = await client.get(f"/tasks/{task_id}")
@@ -150,10 +188,10 @@ async def test_get_task_status(client: AsyncClient, db_session: Session):
     response_data = response.json()
     assert response_data["id"] == task_id
     assert response_data["original_filename"] == "retrievable.txt"
-
-    # Clean up
-    if os.path.exists(task.file_identifier):
-        os.remove(task.file_identifier)
+    assert response_data["status"] == TaskStatus.SCHEDULED.value
+    assert response_data["error_message"] is None
+    # Stored naive by SQLite, returned as UTC
+    assert datetime.fromisoformat(response_data["time_to_print"].replace("Z", "+00:00")) == print_time
 
 async def test_get_task_status_not_found(client: AsyncClient):
     response = await client.get("/tasks/99999") # Non-existent ID
@@ -162,13 +200,12 @@ async def test_get_task_status_not_found(client: AsyncClient):
 
 
 async def test_list_tasks(client: AsyncClient, db_session: Session):
-    # Add a couple of tasks
-    task1_time = datetime.now(timezone.utc) + timedelta(hours=1)
-    task1 = Task(original_filename="task1.txt", uploader_email="lister@example.com", storage_type=StorageType.LOCAL, file_identifier="localtask1", time_to_print=task1_time, color_mode="bw", page_size="A4", status=TaskStatus.SCHEDULED)
-    task2_time = datetime.now(timezone.utc) + timedelta(hours=2)
-    task2 = Task(original_filename="task2.txt", uploader_email="lister@example.com", storage_type=StorageType.LOCAL, file_identifier="localtask2", time_to_print=task2_time, color_mode="color", page_size="Letter", status=TaskStatus.SCHEDULED)
-    
-    db_session.add_all([task1, task2])
+    # Add a couple of tasks in one bulk INSERT
+    common = dict(uploader_email="lister@example.com", storage_type=StorageType.LOCAL, status=TaskStatus.SCHEDULED)
+    db_session.execute(insert(Task), [
+        dict(common, original_filename="task1.txt", file_identifier="localtask1", time_to_print=FROZEN_NOW + timedelta(hours=1), color_mode="bw", page_size="A4"),
+        dict(common, original_filename="task2.txt", file_identifier="localtask2", time_to_print=FROZEN_NOW + timedelta(hours=2), color_mode="color", page_size="Letter"),
+    ])
     db_session.commit()
 
     response = await client.get("/tasks/")
@@ -179,3 +216,32 @@ async def test_list_tasks(client: AsyncClient, db_session: Session):
     filenames_in_response = {t["original_filename"] for t in response_data}
     assert "task1.txt" in filenames_in_response
     assert "task2.txt" in filenames_in_response
+
+
+async def test_list_tasks_newest_first(client: AsyncClient, db_session: Session):
+    older = Task(original_filename="older.txt", uploader_email="lister@example.com", storage_type=StorageType.LOCAL, file_identifier="localolder", time_to_print=FROZEN_NOW + timedelta(hours=1), color_mode="bw", page_size="A4", status=TaskStatus.SCHEDULED, created_at=FROZEN_NOW - timedelta(minutes=5))
+    newer = Task(original_filename="newer.txt", uploader_email="lister@example.com", storage_type=StorageType.LOCAL, file_identifier="localnewer", time_to_print=FROZEN_NOW + timedelta(hours=1), color_mode="bw", page_size="A4", status=TaskStatus.SCHEDULED, created_at=FROZEN_NOW)
+
+    db_session.add_all([older, newer])
+    db_session.commit()
+
+    response = await client.get("/tasks/")
+    assert response.status_code == 200
+    response_data = response.json()
+    assert [t["original_filename"] for t in response_data] == ["newer.txt", "older.txt"]
+    # The list only carries summary columns; file details stay on /tasks/{task_id}
+    assert "file_identifier" not in response_data[0]
+    assert "error_message" not in response_data[0]
+
+
+async def test_cors_preflight_allows_frontend_origin(client: AsyncClient):
+    from backend import FRONTEND_ORIGINS
+    headers = {"Origin": FRONTEND_ORIGINS[0], "Access-Control-Request-Method": "POST"}
+    response = await client.options("/add-task/", headers=headers)
+    assert response.status_code == 200
+    assert response.headers["access-control-allow-origin"] == FRONTEND_ORIGINS[0]
+    assert response.headers["access-control-max-age"] == "86400"
+
+    headers["Origin"] = "http://evil.example"
+    response = await client.options("/add-task/", headers=headers)
+    assert response.status_code == 400
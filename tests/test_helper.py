@@ -0,0 +1,65 @@
+import smtplib
+import pytest
+
+import helper as app_helper
+
+
+@pytest.fixture
+def mock_smtp(mocker):
+    mocker.patch.multiple(
+        app_helper,
+        SMTP_SERVER="smtp.test.com",
+        SMTP_PORT="587",
+        SMTP_USERNAME="user@test.com",
+        SMTP_PASSWORD="password",
+        SENDER_EMAIL="sender@test.com",
+    )
+    app_helper._smtp = None
+    mock_smtp_class = mocker.patch('helper.smtplib.SMTP')
+    yield mock_smtp_class
+    app_helper._smtp = None
+
+
+def test_send_email_reuses_connection(mock_smtp):
+    assert app_helper.send_email("a@test.com", "Subject 1", "Body")
+    assert app_helper.send_email("b@test.com", "Subject 2", "Body")
+
+    mock_smtp.assert_called_once() # Connected (and logged in) only once
+    server = mock_smtp.return_value
+    server.login.assert_called_once_with("user@test.com", "password")
+    assert server.sendmail.call_count == 2
+
+
+def test_send_email_reconnects_after_disconnect(mock_smtp, mocker):
+    stale_server, fresh_server = mocker.MagicMock(), mocker.MagicMock()
+    mock_smtp.side_effect = [stale_server, fresh_server]
+    assert app_helper.send_email("a@test.com", "Subject 1", "Body")
+
+    stale_server.sendmail.side_effect = smtplib.SMTPServerDisconnected("idle timeout")
+    assert app_helper.send_email("b@test.com", "Subject 2", "Body")
+
+    assert mock_smtp.call_count == 2
+    stale_server.close.assert_called_once() # Old socket released, not leaked
+    fresh_server.sendmail.assert_called_once()
+    assert fresh_server.sendmail.call_args[0][1] == "b@test.com"
+
+
+def test_send_email_keeps_connection_after_rejected_recipient(mock_smtp):
+    server = mock_smtp.return_value
+    server.sendmail.side_effect = [smtplib.SMTPRecipientsRefused({"bad@test.com": (550, b"No such user")}), {}]
+
+    assert not app_helper.send_email("bad@test.com", "Subject 1", "Body")
+    assert app_helper.send_email("good@test.com", "Subject 2", "Body")
+
+    mock_smtp.assert_called_once() # Same session reused for the next email
+    server.close.assert_not_called()
+
+
+def test_send_email_closes_connection_on_unexpected_error(mock_smtp):
+    server = mock_smtp.return_value
+    server.sendmail.side_effect = smtplib.SMTPException("protocol error")
+
+    assert not app_helper.send_email("a@test.com", "Subject", "Body")
+
+    server.close.assert_called_once()
+    assert app_helper._smtp is None
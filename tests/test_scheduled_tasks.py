@@ -1,8 +1,12 @@
 import pytest
 import os
-from datetime import datetime, timezone, timedelta
+import subprocess
+import threading
+from concurrent.futures import Future
+from datetime import timedelta
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.orm import Session
-from unittest.mock import MagicMock, patch
+from unittest.mock import DEFAULT, MagicMock, patch
 
 from db import (
     Task, 
@@ -10,32 +14,29 @@ from db import (
     TaskStatus, 
     prepare_gdrive_download_task, 
     print_file_task,
+    poll_due_tasks,
+    remove_orphaned_uploads,
+    recover_interrupted_tasks,
+    init_db,
     SessionLocal 
 )
-from tests.conftest import TEST_GDRIVE_DOWNLOAD_FULL_PATH, TEST_LOCAL_STORAGE_PATH
-
-@pytest.fixture(autouse=True)
-def clear_tasks_before_each_test(db_session: Session):
-    # Clean up any files created by previous tests in this module
-    for root, dirs, files in os.walk(TEST_GDRIVE_DOWNLOAD_FULL_PATH, topdown=False):
-        for name in files:
-            os.remove(os.path.join(root, name))
-    for root, dirs, files in os.walk(TEST_LOCAL_STORAGE_PATH, topdown=False):
-         for name in files:
-            if name.startswith("task_") or name.startswith("local_") or name.startswith("temp_gdrive_"): # Be specific
-                 try:
-                    os.remove(os.path.join(root, name))
-                 except OSError:
-                    pass # File might have been removed by the test itself
-
-    db_session.query(Task).delete()
-    db_session.commit()
-
-
-# The autouse mock_get_gdrive_service in conftest.py handles mocking helper.get_gdrive_service
-def test_prepare_gdrive_download_task_success(db_session: Session, mock_helper_download, mock_scheduler): # Removed mock_gdrive_service_for_downloads
-    # Setup task
-    task_time = datetime.now(timezone.utc) + timedelta(minutes=30)
+import db as app_db
+from tests.conftest import FROZEN_NOW
+
+# The autouse mock_get_gdrive_service in conftest.py handles mocking helper.get_gdrive_service;
+# mock_helper_download is parametrized indirectly with the error the download should raise.
+@pytest.mark.parametrize(
+    "mock_helper_download, expected_status, expected_error",
+    [
+        (None, TaskStatus.SCHEDULED, None),
+        (Exception("Simulated GDrive API Error"), TaskStatus.FAILED, "Simulated GDrive API Error"),
+        (ConnectionError("Google Drive service not available for download."), TaskStatus.FAILED, "Google Drive service not available for download."),
+    ],
+    ids=["success", "api_error", "no_service"],
+    indirect=["mock_helper_download"],
+)
+def test_prepare_gdrive_download_task(db_session: Session, mock_helper_download, mock_helper_send_email, gdrive_download_path, expected_status, expected_error):
+    task_time = FROZEN_NOW + timedelta(minutes=30)
     task = Task(
         original_filename="gdrive_doc.pdf",
         uploader_email="downloader@test.com",
@@ -44,116 +45,37 @@ def test_prepare_gdrive_download_task_success(db_session: Session, mock_helper_d
         time_to_print=task_time,
         color_mode="color",
         page_size="A4",
-        status=TaskStatus.SCHEDULED
-    )
-    db_session.add(task)
-    db_session.commit()
-    db_session.refresh(task)
-
-    # Mock scheduler object passed to the task
-    mock_scheduler_obj = MagicMock()
-    mock_scheduler_obj.remove_job = mock_scheduler["remove_job"] 
-
-    prepare_gdrive_download_task(task.id, mock_scheduler_obj, TEST_GDRIVE_DOWNLOAD_FULL_PATH)
-
-    db_session.refresh(task) 
-    assert task.status == TaskStatus.SCHEDULED 
-    assert task.gdrive_download_path is not None
-    assert os.path.exists(task.gdrive_download_path)
-    # Corrected assertion for filename
-    expected_filename_part = f"task_{task.id}_{task.original_filename}"
-    assert expected_filename_part in task.gdrive_download_path
-    mock_helper_download.assert_called_once_with(task.file_identifier, task.gdrive_download_path)
-    mock_scheduler_obj.remove_job.assert_not_called()
-
-    if task.gdrive_download_path and os.path.exists(task.gdrive_download_path):
-        os.remove(task.gdrive_download_path)
-
-# The autouse mock_get_gdrive_service in conftest.py handles mocking helper.get_gdrive_service
-def test_prepare_gdrive_download_task_failure_api_error(db_session: Session, mock_helper_download, mock_helper_send_email, mock_scheduler): # Removed mock_gdrive_service_for_downloads
-    # Setup task
-    task_time = datetime.now(timezone.utc) + timedelta(minutes=30)
-    task = Task(
-        original_filename="fail_gdrive_doc.pdf",
-        uploader_email="fail_downloader@test.com",
-        storage_type=StorageType.GDRIVE,
-        file_identifier="fail_gdrive_id",
-        time_to_print=task_time,
-        color_mode="bw",
-        page_size="Letter",
-        status=TaskStatus.SCHEDULED
+        status=TaskStatus.DOWNLOADING # Claimed by poll_due_tasks
     )
     db_session.add(task)
     db_session.commit()
-    db_session.refresh(task)
 
-    # This mock will cause the download_from_gdrive (as patched in db module) to raise an exception
-    mock_helper_download.side_effect = Exception("Simulated GDrive API Error")
-    
-    mock_scheduler_obj = MagicMock()
-    mock_scheduler_obj.remove_job = mock_scheduler["remove_job"]
-
-    prepare_gdrive_download_task(task.id, mock_scheduler_obj, TEST_GDRIVE_DOWNLOAD_FULL_PATH)
+    prepare_gdrive_download_task(task.id, gdrive_download_path)
 
     db_session.refresh(task)
-    assert task.status == TaskStatus.FAILED
-    assert "Simulated GDrive API Error" in task.error_message 
-    mock_helper_send_email.assert_called_once() # This should now work as send_email is patched in db
-    assert mock_helper_send_email.call_args[0][0] == task.uploader_email 
-    assert "Print Task Failed" in mock_helper_send_email.call_args[0][1] 
-    mock_scheduler_obj.remove_job.assert_called_once_with(f"print_task_{task.id}")
-
-def test_prepare_gdrive_download_task_failure_no_service(db_session: Session, mock_helper_send_email, mock_scheduler, mocker):
-    # Test scenario where get_gdrive_service itself returns None
-    # This will be picked up by the original download_from_gdrive if it were called,
-    # but our mock_helper_download in conftest.py (patching db.download_from_gdrive)
-    # needs to be made to fail for this specific test.
-    
-    # Mock helper.get_gdrive_service to return None for this specific test
-    # This ensures that when db.download_from_gdrive (the actual one, if our mock was too broad)
-    # or any internal call within db.prepare_gdrive_download_task tries to use it, it gets None.
-    mocker.patch('helper.get_gdrive_service', return_value=None)
-
-    # We also need to make the mocked db.download_from_gdrive raise the ConnectionError
-    # that the original helper.download_from_gdrive would raise.
-    mock_db_download = mocker.patch('db.download_from_gdrive', side_effect=ConnectionError("Google Drive service not available for download."))
-
-
-    task_time = datetime.now(timezone.utc) + timedelta(minutes=30)
-    task = Task(
-        original_filename="no_service_gdrive_doc.pdf",
-        uploader_email="noservice_downloader@test.com",
-        storage_type=StorageType.GDRIVE,
-        file_identifier="noservice_gdrive_id",
-        time_to_print=task_time,
-        color_mode="bw",
-        page_size="Letter",
-        status=TaskStatus.SCHEDULED
-    )
-    db_session.add(task)
-    db_session.commit()
-    db_session.refresh(task)
-    
-    mock_scheduler_obj = MagicMock()
-    mock_scheduler_obj.remove_job = mock_scheduler["remove_job"]
-
-    prepare_gdrive_download_task(task.id, mock_scheduler_obj, TEST_GDRIVE_DOWNLOAD_FULL_PATH)
-
-    db_session.refresh(task)
-    assert task.status == TaskStatus.FAILED
-    assert "Google Drive service not available for download." in task.error_message
-    mock_helper_send_email.assert_called_once() # Patched as db.send_email
-    mock_scheduler_obj.remove_job.assert_called_once_with(f"print_task_{task.id}")
-
-
-def test_print_file_task_local_success(db_session: Session, mock_subprocess_run):
+    assert task.status == expected_status
+    if expected_error is None:
+        assert task.gdrive_download_path is not None
+        assert os.path.exists(task.gdrive_download_path)
+        assert f"task_{task.id}_{task.original_filename}" in task.gdrive_download_path
+        mock_helper_download.assert_called_once_with(task.file_identifier, task.gdrive_download_path)
+        mock_helper_send_email.assert_not_called()
+    else:
+        assert expected_error in task.error_message
+        assert task.gdrive_download_path is None
+        mock_helper_send_email.assert_called_once() # Patched as db.send_email
+        assert mock_helper_send_email.call_args[0][0] == task.uploader_email
+        assert "Print Task Failed" in mock_helper_send_email.call_args[0][1]
+
+
+def test_print_file_task_local_success(db_session: Session, lp_commands, local_storage_path):
     # Setup local task
     local_file_name = "local_to_print.txt"
-    local_file_path = os.path.join(TEST_LOCAL_STORAGE_PATH, local_file_name)
+    local_file_path = os.path.join(local_storage_path, local_file_name)
     with open(local_file_path, "w") as f:
         f.write("content to print locally")
 
-    task_time = datetime.now(timezone.utc) + timedelta(minutes=5)
+    task_time = FROZEN_NOW + timedelta(minutes=5)
     task = Task(
         original_filename=local_file_name,
         uploader_email="printer@test.com",
@@ -162,36 +84,37 @@ def test_print_file_task_local_success(db_session: Session, mock_subprocess_run)
         time_to_print=task_time,
         color_mode="bw",
         page_size="A4",
-        status=TaskStatus.SCHEDULED
+        status=TaskStatus.PRINTING # Claimed by poll_due_tasks
     )
     db_session.add(task)
     db_session.commit()
-    db_session.refresh(task)
 
     printer_name_for_test = os.getenv("PRINTER_NAME", "TestPrinter")
     print_file_task(task.id, printer_name_for_test)
 
     db_session.refresh(task)
     assert task.status == TaskStatus.COMPLETED
-    mock_subprocess_run.assert_called_once()
-    assert mock_subprocess_run.call_args[0][0][-1] == local_file_path # Check file path in lp command
+    assert lp_commands == [("lp", "-d", printer_name_for_test, "-o", "media=A4", "-o", "ColorModel=Gray", local_file_path)]
 
     # Local files are not removed by default in the current print_file_task logic
     assert os.path.exists(local_file_path) 
-    # Clean up if desired for test hygiene, though the task doesn't remove it
-    if os.path.exists(local_file_path):
-        os.remove(local_file_path)
 
 
-def test_print_file_task_gdrive_success(db_session: Session, mock_subprocess_run):
+def test_print_mock_leaves_global_subprocess_run_alone(mock_subprocess_run):
+    # Only db's reference is patched; other code in the session still gets the real one
+    assert subprocess.run.__module__ == "subprocess"
+    assert app_db.run_subprocess is mock_subprocess_run
+
+
+def test_print_file_task_gdrive_success(db_session: Session, lp_commands, gdrive_download_path):
     # Setup GDrive task that has been "downloaded"
     gdrive_orig_filename = "gdrive_to_print.pdf"
     # Simulate that prepare_gdrive_download_task has run
-    downloaded_gdrive_file_path = os.path.join(TEST_GDRIVE_DOWNLOAD_FULL_PATH, f"task_gdrive_{gdrive_orig_filename}")
+    downloaded_gdrive_file_path = os.path.join(gdrive_download_path, f"task_gdrive_{gdrive_orig_filename}")
     with open(downloaded_gdrive_file_path, "w") as f:
         f.write("mock downloaded gdrive content")
 
-    task_time = datetime.now(timezone.utc) + timedelta(minutes=5)
+    task_time = FROZEN_NOW + timedelta(minutes=5)
     task = Task(
         original_filename=gdrive_orig_filename,
         uploader_email="gdrive_printer@test.com",
@@ -201,30 +124,61 @@ def test_print_file_task_gdrive_success(db_session: Session, mock_subprocess_run
         time_to_print=task_time,
         color_mode="color",
         page_size="Letter",
-        status=TaskStatus.SCHEDULED # Status after successful download
+        status=TaskStatus.PRINTING # Downloaded, then claimed by poll_due_tasks
     )
     db_session.add(task)
     db_session.commit()
-    db_session.refresh(task)
     
     printer_name_for_test = os.getenv("PRINTER_NAME", "TestPrinter")
     print_file_task(task.id, printer_name_for_test)
 
     db_session.refresh(task)
     assert task.status == TaskStatus.COMPLETED
-    mock_subprocess_run.assert_called_once()
-    assert mock_subprocess_run.call_args[0][0][-1] == downloaded_gdrive_file_path
+    assert len(lp_commands) == 1
+    assert lp_commands[0][-1] == downloaded_gdrive_file_path # Check file path in lp command
     assert not os.path.exists(downloaded_gdrive_file_path) # Check GDrive temp file was removed
     assert task.gdrive_download_path is None # Check DB path was cleared
 
 
-def test_print_file_task_print_failure(db_session: Session, mock_subprocess_run):
+def test_print_file_task_uses_cups_when_available(db_session: Session, mock_subprocess_run, mocker, local_storage_path):
+    mock_cups = mocker.patch.object(app_db, 'cups')
+    mock_cups.Connection.return_value.printFile.return_value = 17
+    mocker.patch.object(app_db, '_cups_local', threading.local())
+
+    local_file_path = os.path.join(local_storage_path, "cups_print.txt")
+    with open(local_file_path, "w") as f:
+        f.write("content to print over IPP")
+
+    task = Task(
+        original_filename="cups_print.txt",
+        uploader_email="cups@test.com",
+        storage_type=StorageType.LOCAL,
+        file_identifier=local_file_path,
+        time_to_print=FROZEN_NOW + timedelta(minutes=5),
+        color_mode="color",
+        page_size="A4",
+        status=TaskStatus.PRINTING # Claimed by poll_due_tasks
+    )
+    db_session.add(task)
+    db_session.commit()
+
+    print_file_task(task.id, "TestPrinter")
+
+    db_session.refresh(task)
+    assert task.status == TaskStatus.COMPLETED
+    mock_cups.Connection.return_value.printFile.assert_called_once_with(
+        "TestPrinter", local_file_path, "cups_print.txt", {"media": "A4", "ColorModel": "CMYK"}
+    )
+    mock_subprocess_run.assert_not_called()
+
+
+def test_print_file_task_print_failure(db_session: Session, mock_subprocess_run, local_storage_path):
     local_file_name = "fail_print.txt"
-    local_file_path = os.path.join(TEST_LOCAL_STORAGE_PATH, local_file_name)
+    local_file_path = os.path.join(local_storage_path, local_file_name)
     with open(local_file_path, "w") as f:
         f.write("content for failed print")
 
-    task_time = datetime.now(timezone.utc) + timedelta(minutes=5)
+    task_time = FROZEN_NOW + timedelta(minutes=5)
     task = Task(
         original_filename=local_file_name,
         uploader_email="failprinter@test.com",
@@ -233,11 +187,10 @@ def test_print_file_task_print_failure(db_session: Session, mock_subprocess_run)
         time_to_print=task_time,
         color_mode="bw",
         page_size="A4",
-        status=TaskStatus.SCHEDULED
+        status=TaskStatus.PRINTING # Claimed by poll_due_tasks
     )
     db_session.add(task)
     db_session.commit()
-    db_session.refresh(task)
 
     # Simulate print command failure
     mock_process_fail = MagicMock()
@@ -252,5 +205,253 @@ def test_print_file_task_print_failure(db_session: Session, mock_subprocess_run)
     assert task.status == TaskStatus.FAILED
     assert "Printer error: out of paper" in task.error_message
 
-    if os.path.exists(local_file_path):
-        os.remove(local_file_path)
+
+def test_print_file_task_keeps_status_changed_while_printing(db_session: Session, mock_subprocess_run, local_storage_path):
+    local_file_path = os.path.join(local_storage_path, "slow_print.txt")
+    with open(local_file_path, "w") as f:
+        f.write("content for a slow print")
+
+    task = Task(
+        original_filename="slow_print.txt",
+        uploader_email="printer@test.com",
+        storage_type=StorageType.LOCAL,
+        file_identifier=local_file_path,
+        time_to_print=FROZEN_NOW - timedelta(seconds=5),
+        color_mode="bw",
+        page_size="A4",
+        status=TaskStatus.PRINTING # Claimed by poll_due_tasks
+    )
+    db_session.add(task)
+    db_session.commit()
+
+    # Recovery fails the task while lp is still running
+    def recover_during_print(cmd, *args, **kwargs):
+        recover_interrupted_tasks()
+        return DEFAULT
+    mock_subprocess_run.side_effect = recover_during_print
+
+    print_file_task(task.id, "TestPrinter")
+
+    db_session.refresh(task)
+    assert task.status == TaskStatus.FAILED # Not flipped back to COMPLETED
+    assert task.error_message == app_db.INTERRUPTED_PRINT_ERROR
+
+
+def test_poll_due_tasks_dispatches_due_work(db_session: Session, mocker, gdrive_download_path):
+    mock_dispatch = mocker.patch('db._dispatch_task')
+
+    def make_task(name, storage_type, time_to_print, status=TaskStatus.SCHEDULED, gdrive_download_path=None):
+        return Task(
+            original_filename=name,
+            uploader_email="poller@test.com",
+            storage_type=storage_type,
+            file_identifier=f"id_{name}",
+            gdrive_download_path=gdrive_download_path,
+            time_to_print=time_to_print,
+            color_mode="bw",
+            page_size="A4",
+            status=status
+        )
+
+    local_due = make_task("local_due.txt", StorageType.LOCAL, FROZEN_NOW - timedelta(seconds=5))
+    local_later = make_task("local_later.txt", StorageType.LOCAL, FROZEN_NOW + timedelta(minutes=5))
+    gdrive_in_window = make_task("gdrive_window.pdf", StorageType.GDRIVE, FROZEN_NOW + timedelta(minutes=5))
+    gdrive_too_early = make_task("gdrive_early.pdf", StorageType.GDRIVE, FROZEN_NOW + timedelta(hours=1))
+    gdrive_downloaded_due = make_task("gdrive_ready.pdf", StorageType.GDRIVE, FROZEN_NOW - timedelta(seconds=5), gdrive_download_path="some/path.pdf")
+    failed_due = make_task("failed.txt", StorageType.LOCAL, FROZEN_NOW - timedelta(seconds=5), status=TaskStatus.FAILED)
+    db_session.add_all([local_due, local_later, gdrive_in_window, gdrive_too_early, gdrive_downloaded_due, failed_due])
+    db_session.commit()
+
+    poll_due_tasks(gdrive_download_path, "TestPrinter")
+
+    dispatched = {c.args[:3] for c in mock_dispatch.call_args_list}
+    assert dispatched == {
+        (app_db.download_executor, prepare_gdrive_download_task, gdrive_in_window.id),
+        (app_db.print_executor, print_file_task, local_due.id),
+        (app_db.print_executor, print_file_task, gdrive_downloaded_due.id),
+    }
+
+    # Dispatched tasks were claimed, so the next poll (here or in another worker) skips them
+    for task in (gdrive_in_window, local_due, gdrive_downloaded_due, local_later):
+        db_session.refresh(task)
+    assert gdrive_in_window.status == TaskStatus.DOWNLOADING
+    assert local_due.status == TaskStatus.PRINTING
+    assert gdrive_downloaded_due.status == TaskStatus.PRINTING
+    assert local_later.status == TaskStatus.SCHEDULED
+
+    mock_dispatch.reset_mock()
+    poll_due_tasks(gdrive_download_path, "TestPrinter")
+    mock_dispatch.assert_not_called()
+
+
+@pytest.mark.parametrize("status", [TaskStatus.SCHEDULED, TaskStatus.COMPLETED, TaskStatus.FAILED])
+def test_print_file_task_skips_unclaimed_task(db_session: Session, lp_commands, local_storage_path, status):
+    local_file_path = os.path.join(local_storage_path, "already_done.txt")
+    with open(local_file_path, "w") as f:
+        f.write("printed once already")
+
+    task = Task(
+        original_filename="already_done.txt",
+        uploader_email="printer@test.com",
+        storage_type=StorageType.LOCAL,
+        file_identifier=local_file_path,
+        time_to_print=FROZEN_NOW - timedelta(minutes=5),
+        color_mode="bw",
+        page_size="A4",
+        status=status
+    )
+    db_session.add(task)
+    db_session.commit()
+
+    print_file_task(task.id, "TestPrinter")
+
+    db_session.refresh(task)
+    assert task.status == status
+    assert lp_commands == []
+
+
+def test_prepare_gdrive_download_task_skips_unclaimed_task(db_session: Session, mock_helper_download, gdrive_download_path):
+    # Already downloaded and waiting to print: a stray second dispatch must not fetch it again
+    task = Task(
+        original_filename="downloaded.pdf",
+        uploader_email="downloader@test.com",
+        storage_type=StorageType.GDRIVE,
+        file_identifier="downloaded_gdrive_id",
+        gdrive_download_path=os.path.join(gdrive_download_path, "task_downloaded.pdf"),
+        time_to_print=FROZEN_NOW + timedelta(minutes=5),
+        color_mode="bw",
+        page_size="A4",
+        status=TaskStatus.SCHEDULED
+    )
+    db_session.add(task)
+    db_session.commit()
+
+    prepare_gdrive_download_task(task.id, gdrive_download_path)
+
+    mock_helper_download.assert_not_called()
+
+
+def test_cancelled_dispatch_releases_claim(db_session: Session):
+    # Executor shutdown cancels queued jobs; their tasks must go back to SCHEDULED
+    task = Task(
+        original_filename="queued.txt",
+        uploader_email="poller@test.com",
+        storage_type=StorageType.LOCAL,
+        file_identifier="queued.txt",
+        time_to_print=FROZEN_NOW - timedelta(seconds=5),
+        color_mode="bw",
+        page_size="A4",
+        status=TaskStatus.PRINTING
+    )
+    db_session.add(task)
+    db_session.commit()
+
+    cancelled = Future()
+    cancelled.cancel()
+    app_db._task_done(task.id, cancelled)
+
+    db_session.refresh(task)
+    assert task.status == TaskStatus.SCHEDULED
+
+
+def test_remove_orphaned_uploads(db_session: Session, tmp_path):
+    referenced = tmp_path / "local_abc_kept.txt"
+    orphan = tmp_path / "local_def_orphan.txt"
+    temp_upload = tmp_path / "temp_ghi_partial.bin"
+    unrelated = tmp_path / "notes.txt"
+    fresh_temp_upload = tmp_path / "temp_jkl_uploading.bin"
+    fresh_orphan = tmp_path / "local_mno_committing.txt"
+    # Everything is older than the grace period except the two "fresh" files
+    stale_mtime = (FROZEN_NOW - app_db.ORPHANED_UPLOAD_GRACE_PERIOD - timedelta(minutes=1)).timestamp()
+    fresh_mtime = (FROZEN_NOW - timedelta(minutes=1)).timestamp()
+    for path in (referenced, orphan, temp_upload, unrelated, fresh_temp_upload, fresh_orphan):
+        path.write_text("data")
+        mtime = fresh_mtime if path in (fresh_temp_upload, fresh_orphan) else stale_mtime
+        os.utime(path, (mtime, mtime))
+
+    db_session.add(Task(
+        original_filename="kept.txt",
+        uploader_email="cleanup@test.com",
+        storage_type=StorageType.LOCAL,
+        file_identifier=str(referenced),
+        time_to_print=FROZEN_NOW + timedelta(minutes=5),
+        color_mode="bw",
+        page_size="A4",
+        status=TaskStatus.SCHEDULED
+    ))
+    db_session.commit()
+
+    remove_orphaned_uploads(str(tmp_path))
+
+    assert referenced.exists()
+    assert unrelated.exists()
+    assert not orphan.exists()
+    assert not temp_upload.exists()
+    # Possibly still being uploaded or committed by a running request
+    assert fresh_temp_upload.exists()
+    assert fresh_orphan.exists()
+
+
+def test_recover_interrupted_tasks(db_session: Session):
+    task_time = FROZEN_NOW + timedelta(minutes=5)
+    interrupted = Task(
+        original_filename="interrupted.pdf",
+        uploader_email="recovery@test.com",
+        storage_type=StorageType.GDRIVE,
+        file_identifier="interrupted_gdrive_id",
+        gdrive_download_path="partial/path.pdf",
+        time_to_print=task_time,
+        color_mode="bw",
+        page_size="A4",
+        status=TaskStatus.DOWNLOADING
+    )
+    completed = Task(
+        original_filename="done.txt",
+        uploader_email="recovery@test.com",
+        storage_type=StorageType.LOCAL,
+        file_identifier="done.txt",
+        time_to_print=task_time,
+        color_mode="bw",
+        page_size="A4",
+        status=TaskStatus.COMPLETED
+    )
+    printing = Task(
+        original_filename="mid_print.txt",
+        uploader_email="recovery@test.com",
+        storage_type=StorageType.LOCAL,
+        file_identifier="mid_print.txt",
+        time_to_print=task_time,
+        color_mode="bw",
+        page_size="A4",
+        status=TaskStatus.PRINTING
+    )
+    db_session.add_all([interrupted, completed, printing])
+    db_session.commit()
+
+    assert recover_interrupted_tasks() == 2
+
+    for task in (interrupted, completed, printing):
+        db_session.refresh(task)
+    assert interrupted.status == TaskStatus.SCHEDULED
+    assert interrupted.gdrive_download_path is None
+    assert completed.status == TaskStatus.COMPLETED
+    # Not re-queued: the job may already have reached the printer
+    assert printing.status == TaskStatus.FAILED
+    assert printing.error_message == app_db.INTERRUPTED_PRINT_ERROR
+
+
+def test_init_db_adds_missing_indexes_to_existing_table(tmp_path, monkeypatch):
+    # A database created before the indexes were added to Task: the table exists
+    # without them, so create_all alone would leave them missing.
+    legacy_engine = create_engine(f"sqlite:///{tmp_path / 'tasks.db'}")
+    Task.metadata.create_all(bind=legacy_engine)
+    with legacy_engine.begin() as conn:
+        conn.execute(text("DROP INDEX ix_tasks_created_at_desc"))
+        conn.execute(text("DROP INDEX ix_tasks_status_time_to_print"))
+    monkeypatch.setattr(app_db, "engine", legacy_engine)
+
+    init_db()
+
+    index_names = {index["name"] for index in inspect(legacy_engine).get_indexes("tasks")}
+    assert {"ix_tasks_created_at_desc", "ix_tasks_status_time_to_print"} <= index_names
+    legacy_engine.dispose()